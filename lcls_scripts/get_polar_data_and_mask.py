@@ -9,7 +9,7 @@ from scipy.signal import argrelmax
 import pylab as plt
 
 from loki.RingData import RadialProfile, InterpSimple
-from loki.utils.postproc_helper import smooth, bin_ndarray
+from loki.utils.postproc_helper import smooth
 import psana
 
 def fit_line(data):
@@ -121,7 +121,9 @@ print("polar image dimensions:  %d x %d"%(rbin_new, phibin_new))
 
 Interp = InterpSimple( cent[0], cent[1] , interp_rmax, interp_rmin, nphi, img_sh)  
 pmask = Interp.nearest(mask).astype(int).astype(float)
-pmask_bn = bin_ndarray( pmask, binned_pol_img_sh)
+# interpolates and bins the polar image in one step, without making
+# the full resolution polar image
+pmask_bn = Interp.set_polar_binning( binned_pol_img_sh, mask=mask)
 
 # print pmask.shape,pmask_bn.shape
 # if (rbin_fct==1 and phibin_fct==1):
@@ -211,12 +213,12 @@ for i,evt in enumerate(events):
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 # ~~~Interpolation to polar
-    polar_img = Interp.nearest( img) * pmask
     if (rbin_fct==1 and phibin_fct==1):
         print('not binning polar img')
+        polar_img = Interp.nearest( img) * pmask
         smldata.event(polar_imgs=polar_img.astype(np.float32))
     else:
-        polar_img_bn = bin_ndarray( polar_img, binned_pol_img_sh)* pmask_bn
+        polar_img_bn = Interp.nearest_binned( img)* pmask_bn
         smldata.event(polar_imgs=polar_img_bn.astype(np.float32))
     smldata.event(radial_profs=rad_pro.astype(np.float32))
     count+=1
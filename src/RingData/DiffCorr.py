@@ -110,14 +110,33 @@ class DiffCorr:
         fx_2 = np.fft.rfft( ar_2, n = n, axis=axis )
         return np.fft.irfft( fx* np.conjugate( fx_2), n=n, axis=axis)
 
-    def autocorr(self): 
+    def autocorr(self, out=None, dtype=np.float64, chunk_size=256): 
         '''
         Return the difference autocorrelation
         =====================================
+        out         - optional pre-allocated output array with the shape
+                        of the shots (num_shot x num_q x num_phi)
+        dtype       - data type of the output (ignored if out is given); 
+                        the shots are cast to it before the FFTs, which 
+                        numpy < 2.0 computes in double precision anyway
+        chunk_size  - number of shots transformed at once, bounds the 
+                        memory used on top of the output
         '''
         assert( not self.generate_mode)
-        corr = np.array( [ self._fft_autocorr(s) for s in self.shotsAB ] )
-        return corr
+        num_shots = self.shotsAB.shape[0]
+        n = self.shotsAB.shape[-1]
+        if out is None:
+            out = np.zeros( self.shotsAB.shape, dtype=dtype)
+        assert( out.shape == self.shotsAB.shape)
+        
+        for start in range( 0, num_shots, chunk_size):
+            stop = min( start + chunk_size, num_shots)
+            chunk = np.asarray( self.shotsAB[start:stop], dtype=out.dtype)
+            fx = np.fft.rfft( chunk, n=n, axis=-1)
+#           same as fx * np.conjugate(fx), without the complex product
+            power = fx.real**2 + fx.imag**2
+            out[start:stop] = np.fft.irfft( power, n=n, axis=-1)
+        return out
     
     def autocorr_generator(self): 
         '''
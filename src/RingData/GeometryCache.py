@@ -0,0 +1,110 @@
+import os
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+
+class GeometryCache:
+    def __init__(self, cache_dir):
+        '''
+        Description
+        ===========
+        A content-addressed directory of precomputed geometry operators
+        (pixel indices, weights, sparse interpolation matrices). Each
+        entry is a sub-directory of .npy files named by a hash of the
+        parameters that define the geometry, and is loaded back with
+        memory mapping, so jobs sharing a geometry skip the setup.
+
+        Parameters
+        ==========
+        `cache_dir` is the directory where the operators are stored,
+            it is created if it does not exist
+        '''
+        self.cache_dir = cache_dir
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+#               another worker made it first
+                assert(os.path.isdir(self.cache_dir))
+
+    @staticmethod
+    def make_key(*params):
+        '''
+        Hash a sequence of parameters; numpy arrays are hashed by their
+        shape, dtype and contents, everything else by its repr
+        '''
+        sha = hashlib.sha1()
+        for p in params:
+            if isinstance(p, np.ndarray):
+                p = np.ascontiguousarray(p)
+                sha.update(repr((p.shape, p.dtype.str)).encode())
+                sha.update(p.view(np.uint8).ravel().tobytes())
+            else:
+                sha.update(repr(p).encode())
+            sha.update(b'|')
+        return sha.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def has(self, key):
+        return os.path.isdir(self._entry_dir(key))
+
+    def load(self, key):
+        '''
+        Returns a dictionary of the arrays (and sparse matrices) stored
+        under `key`, or None if there is no such entry
+        '''
+        entry_dir = self._entry_dir(key)
+        if not os.path.isdir(entry_dir):
+            return None
+
+        arrays = {}
+        for fname in os.listdir(entry_dir):
+            if not fname.endswith('.npy'):
+                continue
+            name = fname[:-4]
+            arrays[name] = np.load(os.path.join(entry_dir, fname),
+                                   mmap_mode='r')
+
+        for name in [n[:-len('.csr_shape')] for n in list(arrays)
+                     if n.endswith('.csr_shape')]:
+            arrays[name] = sparse.csr_matrix(
+                (arrays.pop(name + '.csr_data'),
+                 arrays.pop(name + '.csr_indices'),
+                 arrays.pop(name + '.csr_indptr')),
+                shape=tuple(arrays.pop(name + '.csr_shape')))
+        return arrays
+
+    def save(self, key, arrays):
+        '''
+        Store a dictionary of numpy arrays and sparse matrices under
+        `key`. The entry is written to a temporary directory and then
+        renamed, so concurrent jobs never see a partial entry.
+        '''
+        entry_dir = self._entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return
+
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        for name, arr in arrays.items():
+            if sparse.issparse(arr):
+                arr = arr.tocsr()
+                np.save(os.path.join(tmp_dir, name + '.csr_data.npy'), arr.data)
+                np.save(os.path.join(tmp_dir, name + '.csr_indices.npy'),
+                        arr.indices)
+                np.save(os.path.join(tmp_dir, name + '.csr_indptr.npy'),
+                        arr.indptr)
+                np.save(os.path.join(tmp_dir, name + '.csr_shape.npy'),
+                        np.array(arr.shape))
+            else:
+                np.save(os.path.join(tmp_dir, name + '.npy'), np.asarray(arr))
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+#           another job stored the same entry in the meantime
+            shutil.rmtree(tmp_dir)
@@ -1,7 +1,10 @@
-import h5py
 import numpy as np
 from scipy.ndimage import zoom
 import numpy.ma as ma
+from scipy import sparse
+
+from loki.RingData.GeometryCache import GeometryCache
+from loki.RingData.RingIndexFile import RingIndexFile
 
 
 
@@ -9,7 +12,7 @@ class InterpSimple:
 
     def __init__(self, a, b, 
         qRmax, qRmin, 
-        nphi, raw_img_shape):
+        nphi, raw_img_shape, cache_dir=None):
         '''
         Define a polar image with dimensions: (qRmax-qRmin) x nphi
         ==========================================================
@@ -20,6 +23,13 @@ class InterpSimple:
         nphi          - int, azimuthal dimension of polar image
                             (number of azimuthal points along polar image)
         raw_img_shape - int tuple, ydim, xdim of the raw image
+        cache_dir     - str, optional directory where the polar indices are
+                            stored and re-used by other jobs with the
+                            same geometry (see GeometryCache)
+
+        The nearest-pixel indices are computed here; the four-neighbour 
+        indices and weights of bilinear are computed on its first call,
+        so instances that only use nearest do not hold them.
         '''
         self.x_center = a
         self.y_center = b
@@ -33,6 +43,28 @@ class InterpSimple:
         self.X = raw_img_shape[1]  # fast dimension
         self.Y = raw_img_shape[0]  # slow dimension
 
+        self._bilinear_inds = None
+        self._bilinear_weights = None
+
+        if cache_dir is None:
+            self._set_polar_indices()
+        else:
+            self._load_or_set_polar_indices(cache_dir)
+
+    def _load_or_set_polar_indices(self, cache_dir):
+        cache = GeometryCache(cache_dir)
+        key = GeometryCache.make_key('InterpSimple',
+            float(self.x_center), float(self.y_center),
+            float(self.qRmax), float(self.qRmin), int(self.num_phis_ring),
+            (int(self.Y), int(self.X)))
+        arrays = cache.load(key)
+        if arrays is None:
+            self._set_polar_indices()
+            cache.save(key, {'indices_1d': self.indices_1d})
+        else:
+            self.indices_1d = arrays['indices_1d']
+
+    def _set_polar_coordinates(self):
         self.Q = np.vstack([np.ones(self.num_phis_ring) * iq
                             for iq in np.arange(self.qRmin, self.qRmax)])
         self.PHI = np.vstack([self.phis_ring
@@ -40,6 +72,8 @@ class InterpSimple:
         self.xring = self.Q * np.cos(self.PHI - np.pi) + self.x_center
         self.yring = self.Q * np.sin(self.PHI - np.pi) + self.y_center
 
+    def _set_polar_indices(self):
+        self._set_polar_coordinates()
         self.xring_near = self.xring.astype(int) + \
             np.round(self.xring -
                      np.floor(self.xring)).astype(int)
@@ -50,10 +84,132 @@ class InterpSimple:
         self.indices_1d = self.X * self.yring_near + self.xring_near
 
     def nearest(self, data_img, 
-        dtype=np.float32, mask = None):
-        '''return a 2d np.array polar image'''
+        dtype=np.float32, mask = None, out=None):
+        '''
+        return a 2d np.array polar image
+        ================================
+        dtype       - data type of the polar image (ignored if out is given)
+        out         - optional pre-allocated polar image to write into,
+                        re-using it avoids an allocation per image
+        '''
+        if out is None:
+            out = np.zeros( self.indices_1d.shape, dtype=dtype)
+        assert( out.shape == self.indices_1d.shape)
+        _take_into( data_img.ravel(), self.indices_1d, out)
+        return out
+
+    def _set_bilinear_weights(self):
+        '''
+        Indices and weights of the four pixels surrounding each polar
+        point (pixel centers are at integer coordinates)
+        '''
+        if not hasattr(self, 'xring'):
+            self._set_polar_coordinates()
+        x0 = np.floor(self.xring)
+        y0 = np.floor(self.yring)
+        fx = self.xring - x0
+        fy = self.yring - y0
+        x0 = x0.astype(int)
+        y0 = y0.astype(int)
+        x1 = np.clip(x0 + 1, 0, self.X - 1)
+        y1 = np.clip(y0 + 1, 0, self.Y - 1)
+        x0 = np.clip(x0, 0, self.X - 1)
+        y0 = np.clip(y0, 0, self.Y - 1)
+        self._bilinear_inds = np.array([self.X * y0 + x0,
+                                        self.X * y0 + x1,
+                                        self.X * y1 + x0,
+                                        self.X * y1 + x1])
+        self._bilinear_weights = np.array([(1 - fx) * (1 - fy),
+                                           fx * (1 - fy),
+                                           (1 - fx) * fy,
+                                           fx * fy])
+
+    def bilinear(self, data_img):
+        '''
+        return a 2d np.array polar image, bilinearly interpolated
+        from the four pixels surrounding each polar point. The
+        neighbour indices and weights are computed on the first call
+        and re-used for every subsequent image.
+        '''
+        if self._bilinear_inds is None:
+            self._set_bilinear_weights()
         data = data_img.ravel()
-        return data[self.indices_1d]
+        polar_img = data[self._bilinear_inds[0]] * self._bilinear_weights[0]
+        for inds, weights in zip(self._bilinear_inds[1:],
+                                 self._bilinear_weights[1:]):
+            polar_img += data[inds] * weights
+        return polar_img
+
+    def set_polar_binning(self, binned_shape, mask=None):
+        '''
+        Precompute one operator that interpolates (nearest) and bins the
+        polar image in a single step
+        ================================================================
+        binned_shape  - int tuple, (rbins, phibins), the dimensions of the
+                            binned polar image; these must evenly divide
+                            (qRmax-qRmin) x nphi
+        mask          - 2d bool np.array, raw image mask (True is
+                            unmasked), masked polar pixels are excluded
+                            from the bins
+
+        returns the binned polar mask, the number of unmasked polar
+            pixels summed into each bin
+        '''
+        num_r, num_phi = self.indices_1d.shape
+        rbins, phibins = binned_shape
+        assert( num_r % rbins == 0 and num_phi % phibins == 0)
+        rfac = num_r // rbins
+        phifac = num_phi // phibins
+
+        r_inds, phi_inds = np.indices( self.indices_1d.shape)
+        bin_inds = (r_inds // rfac) * phibins + phi_inds // phifac
+        if mask is None:
+            pmask = np.ones( self.indices_1d.shape)
+        else:
+            pmask = mask.ravel()[self.indices_1d].astype(float)
+
+        self._binned_shape = (rbins, phibins)
+        self._binning_op = sparse.csr_matrix(
+            (pmask.ravel(), (bin_inds.ravel(), self.indices_1d.ravel())),
+            shape=(rbins * phibins, self.X * self.Y))
+        self.binned_mask = np.bincount( bin_inds.ravel(),
+            weights=pmask.ravel(), minlength=rbins*phibins)
+        self.binned_mask = self.binned_mask.reshape( self._binned_shape)
+        return self.binned_mask
+
+    def nearest_binned(self, data_img):
+        '''
+        return the 2d binned polar image, the sum of the unmasked
+        nearest-pixel polar samples in each bin (see set_polar_binning)
+        '''
+        binned = self._binning_op.dot( data_img.ravel())
+        return binned.reshape( self._binned_shape)
+
+    def nearest_stack(self, stack, out=None, chunk_size=100):
+        '''
+        Polar-interpolate a stack of images in one gather per chunk
+        ===========================================================
+        stack       - 3d array (num_shots x Y x X), or anything that
+                        can be sliced like one (e.g. an h5py dataset)
+        out         - optional pre-allocated output array of shape
+                        (num_shots x num_radii x nphi)
+        chunk_size  - how many images are read from stack per gather
+
+        returns out, the stack of polar images
+        '''
+        assert( tuple(stack.shape[1:]) == (self.Y, self.X) )
+        num_shots = stack.shape[0]
+        out_shape = (num_shots,) + self.indices_1d.shape
+        if out is None:
+            out = np.zeros( out_shape, dtype=np.float32)
+        assert( out.shape == out_shape)
+
+        for start in range(0, num_shots, chunk_size):
+            stop = min(start + chunk_size, num_shots)
+            chunk = np.asarray(stack[start:stop])
+            flat_chunk = chunk.reshape((stop - start, -1))
+            _take_into(flat_chunk, self.indices_1d, out[start:stop], axis=1)
+        return out
     
 
     def set_polar_tree( self, index_query_fname, weighted=True): 
@@ -63,23 +219,57 @@ class InterpSimple:
         #    for r in np.arange(self.qRmin, self.qRmax)]
         #self._dists, self._inds =  zip(*[ PT.tree.query(rps, k=4) for rps in ring_pts])
         
-        qf = h5py.File(index_query_fname, 'r')
-        if weighted:
-            grp = qf['nearest4']
-            self.weighted = True 
+        index_file = RingIndexFile(index_query_fname)
+        radii = np.arange(self.qRmin,self.qRmax)
+        self.weighted = weighted
+#       per dtype gather buffer and weights of nearest_query
+        self._query_scratch = {}
+#       stack the rings, every radius must have the same number of phi points
+        if self.weighted:
+            dists, self._inds = index_file.rings('nearest4', radii)
+            self._weights = dists / dists.sum(-1)[...,None]
         else:
-            self.weighted = False
-            grp = qf['nearest']
-        self._inds =  [ grp['inds'][r].value   
-            for r in list(map( str,np.arange(self.qRmin,self.qRmax)))]
-        self._dists =  [ grp['dists'][r].value   
-            for r in list(map( str,np.arange(self.qRmin,self.qRmax)))]
-
-    def nearest_query(self, data_img, dtype=np.float32, weighted=True):
+            dists, self._inds = index_file.rings('nearest', radii)
+
+    def nearest_query(self, data_img, dtype=np.float32, weighted=True, 
+        out=None):
+        '''
+        return a 2d np.array polar image using the index query file
+        (see set_polar_tree)
+        ==========================================================
+        dtype       - data type of the polar image (ignored if out is given)
+        out         - optional pre-allocated polar image to write into
+        '''
+        out_shape = self._inds.shape[:2]
+        if out is None:
+            out = np.zeros( out_shape, dtype=dtype)
+        assert( out.shape == out_shape)
         data = data_img.ravel()
         if self.weighted:
-            rings = np.array( [ np.average(data[i], axis=1, weights=d/d.sum(1)[:,None]) 
-                for i,d in zip(self._inds, self._dists) ] )
+            buf, weights = self._get_query_scratch( out.dtype)
+            _take_into( data, self._inds, buf)
+            np.einsum( 'ijk,ijk->ij', buf, weights, out=out)
         else:
-            rings = np.array( [ data[i] for i in self._inds ] )
-        return rings
+            _take_into( data, self._inds, out)
+        return out
+
+    def _get_query_scratch(self, dtype):
+        dtype = np.dtype( dtype)
+        if dtype not in self._query_scratch:
+            self._query_scratch[dtype] = ( 
+                np.zeros( self._inds.shape, dtype=dtype), 
+                self._weights.astype( dtype) )
+        return self._query_scratch[dtype]
+
+
+def _take_into(data, inds, out, axis=None):
+    '''
+    Gather data[inds] (along axis) into out; np.take only writes into an
+    out of the same dtype as data, other dtypes are cast on assignment
+    '''
+    if data.dtype == out.dtype:
+        np.take( data, inds, axis=axis, out=out)
+    elif axis is None:
+        out[...] = data[inds]
+    else:
+        out[...] = np.take( data, inds, axis=axis)
@@ -1,11 +1,12 @@
 import numpy as np
+from scipy import sparse
 from scipy.stats import binned_statistic
 
 from loki.RingData import RingFetch
 
 class RadialProfile:
     def __init__( self, center, img_shape=(2399,2399), mask=None, 
-                                minlength=1800 ):
+                                minlength=1800, compact=False ):
         """
         center: float tuple, the usual (horizontal,vertical) tuple, 
                 corresponding to the pixel coordinate where the forward 
@@ -20,17 +21,37 @@ class RadialProfile:
         minlength:  The minimum length of the radial profile. Force this to be
                     high so that multiple radial profiles will have
                     the same length
+
+        compact:    only keep the radial bin of each pixel (as uint16, or 
+                    int32 for very large images) and the number of pixels 
+                    per bin. The index grids self.Y and self.X are never 
+                    stored, and the radial sort used by calculate_stats and
+                    calculate2 is made the first time it is needed.
         """
         self.x_center = center[0]
         self.y_center = center[1]
         self.minlength = minlength
         self.mask = mask
+        self.img_shape = tuple( img_shape)
+        self.compact = compact
 
 #       Make the radius of each pixel
-        self.Y, self.X = np.indices( img_shape )
+        if self.compact:
+            max_radius = np.sqrt( self.img_shape[0]**2 + self.img_shape[1]**2 )
+            if max_radius + abs( self.x_center) + abs( self.y_center) < 2**16:
+                self._label_dtype = np.uint16
+            else:
+                self._label_dtype = np.int32
+        else:
+            self.Y, self.X = np.indices( img_shape )
         self._set_R()
         self._set_normalization()
-        self._set_R_sorted_idx()
+        if self.compact:
+            self._sorted_center = None
+        else:
+            self._set_R_sorted_idx()
+        self._integrator_op = None
+        self._integrator_params = None
 
         self.wavelen = None
         self.pixsize = None
@@ -40,15 +61,61 @@ class RadialProfile:
     def _set_R_sorted_idx(self):
         self.R1 = self.R.ravel()
         self.sort_idx = np.argsort( self.R1 )
+        if self.compact:
+            self.sort_idx = self.sort_idx.astype( np.int32)
         Rsort = self.R1[self.sort_idx]
         self.Rsort_bin_edge = np.where( Rsort[1:] - Rsort[:-1] == 1)[0] + 1
         self.Rsort_bin_edge =  np.array( \
             [0] + list( self.Rsort_bin_edge) + [ len( self.R1) ] )
+#       runs of equal radius over all pixels, and their radial bins
+        self._Rsort_starts = np.concatenate( 
+                            ([0], np.where( np.diff(Rsort) )[0] + 1) )
+        self._Rsort_bins = Rsort[ self._Rsort_starts]
+#       the segments of unmasked pixels are made by calculate_stats
+        self._stat_idx = None
+        self._sorted_center = (self.x_center, self.y_center)
+
+    def _check_R_sorted_idx(self):
+#       the sorting is redone lazily after update_center
+        if self._sorted_center != (self.x_center, self.y_center):
+            self._set_R_sorted_idx()
+
+    def _check_stat_segments(self):
+        self._check_R_sorted_idx()
+        if self._stat_idx is None:
+            self._set_stat_segments()
+
+    def _set_stat_segments(self):
+#       unmasked pixels sorted by radius, split into runs of equal radius;
+#       each run starts at _stat_starts and belongs to radial bin _stat_bins
+        if self.mask is None:
+            self._stat_idx = self.sort_idx
+        else:
+            keep = self.mask.ravel()[self.sort_idx].astype(bool)
+            self._stat_idx = self.sort_idx[keep]
+        Rstat = self.R1[ self._stat_idx]
+        self._stat_starts = np.concatenate( 
+                            ([0], np.where( np.diff(Rstat) )[0] + 1) )
+        self._stat_starts = self._stat_starts[ self._stat_starts < len(Rstat) ]
+        self._stat_bins = Rstat[ self._stat_starts]
+        self._stat_counts = np.diff( np.append( self._stat_starts, len(Rstat)))
     
+    def _pixel_offsets(self):
+#       vertical and horizontal offsets of the pixels from the center; in 
+#       compact mode these are a column and a row that broadcast together
+        if self.compact:
+            Y, X = np.ogrid[ :self.img_shape[0], :self.img_shape[1] ]
+        else:
+            Y, X = self.Y, self.X
+        return Y - self.y_center, X - self.x_center
+
     def _set_R(self):
-        self.R = np.sqrt((self.Y-self.y_center)**2 + \
-                        (self.X-self.x_center)**2)
-        self.R = self.R.astype(int)
+        dy, dx = self._pixel_offsets()
+        self.R = np.sqrt( dy**2 + dx**2 )
+        if self.compact:
+            self.R = self.R.astype( self._label_dtype)
+        else:
+            self.R = self.R.astype(int)
         self.Rbins = np.arange( self.R.max()+1) 
     
     def _set_normalization(self):
@@ -56,30 +123,222 @@ class RadialProfile:
             self.num_pixels_per_radial_bin = np.bincount( self.R.ravel(), 
                                     minlength=self.minlength)
         else:
-            self.num_pixels_per_radial_bin = \
-                            np.bincount(self.R[self.mask].ravel(), 
+#           the mask is applied once, by keeping only the unmasked pixels
+            self._valid_idx = np.flatnonzero( self.mask)
+            if self.compact:
+                self._valid_idx = self._valid_idx.astype( np.int32)
+            self._valid_R = self.R.ravel()[ self._valid_idx]
+            self.num_pixels_per_radial_bin = np.bincount( self._valid_R, 
                                     minlength=self.minlength)
 
+    def _summed_intensity_per_radial_bin(self, img):
+        if self.mask is None:
+            return np.bincount( self.R.ravel(), weights=img.ravel(), 
+                                minlength=self.minlength)
+        return np.bincount( self._valid_R, 
+                            weights=img.ravel()[ self._valid_idx], 
+                            minlength=self.minlength)
+
     def calculate(self, img):
         """
         img:   2-dimensional image to be radially binned
         
         returns the 1-dimensional radial profile of img
         """
-        if self.mask is None:
-            summed_intensity_per_radial_bin = np.bincount( self.R.ravel(), 
-                                                weights=img.ravel(), 
-                                                minlength=self.minlength)
-        else:
-            summed_intensity_per_radial_bin = np.bincount( self.R.ravel(), 
-                                                weights=(self.mask*img).ravel(), 
-                                                minlength=self.minlength)
+        summed_intensity_per_radial_bin = \
+                            self._summed_intensity_per_radial_bin( img)
 
         radial_profile = summed_intensity_per_radial_bin / \
                             self.num_pixels_per_radial_bin
 
         return np.nan_to_num(radial_profile)
     
+    def calculate_many(self, stack, out=None, chunk_size=100):
+        """
+        stack:  3-dimensional array (num_shots x Y x X) of images to be 
+                radially binned, or anything that can be sliced like one 
+                (e.g. an h5py dataset, which is then read chunk by chunk)
+        out:    optional pre-allocated output array of shape 
+                (num_shots x num_radial_bins)
+        chunk_size: how many images are read from stack at once
+
+        returns out, row i is the same as calculate(stack[i])
+
+        This is a convenience for reading stacks in chunks, it is not 
+        faster than calling calculate on every image: each image is 
+        summed with the same bincount (one bincount over a whole chunk, 
+        with the labels offset per image, measured slower).
+        """
+        num_shots = stack.shape[0]
+        num_bins = len( self.num_pixels_per_radial_bin)
+        assert( tuple(stack.shape[1:]) == self.R.shape )
+        if out is None:
+            out = np.zeros( (num_shots, num_bins) )
+        assert( out.shape == (num_shots, num_bins) )
+
+        for start in range( 0, num_shots, chunk_size):
+            stop = min( start + chunk_size, num_shots)
+            chunk = np.asarray( stack[start:stop])
+            for i_shot, img in enumerate( chunk):
+                np.divide( self._summed_intensity_per_radial_bin( img), 
+                            self.num_pixels_per_radial_bin, 
+                            out=out[start + i_shot] )
+        return np.nan_to_num( out, copy=False)
+
+    def calculate_windowed(self, img, centers, rmin, rmax, chunk_size=16):
+        """
+        img:     2-dimensional image to be radially binned
+        centers: sequence of (horizontal,vertical) candidate centers
+        rmin:    first radial bin of the window
+        rmax:    radial bins rmin..rmax-1 are returned
+        chunk_size: number of centers evaluated at once
+
+        returns an array of shape (len(centers), rmax-rmin), row i is 
+        the same as calculate(img)[rmin:rmax] after update_center(centers[i])
+
+        The pixels of one image row that fall into radial bin k form at
+        most two runs of columns, one on either side of the center, whose
+        ends follow from the circle equation. The bin sums are therefore
+        differences of row-wise cumulative sums, and no per-pixel radii
+        are computed for any of the centers.
+        """
+        assert( 0 <= rmin < rmax )
+        centers = np.asarray( centers, dtype=float).reshape( (-1,2) )
+        
+        if self.mask is None:
+            img_cumsum = self._row_cumsum( img)
+            pix_cumsum = None
+        else:
+            img_cumsum = self._row_cumsum( self.mask*img)
+            pix_cumsum = self._row_cumsum( self.mask)
+
+        profiles = np.zeros( (len(centers), rmax-rmin) )
+        for start in range( 0, len(centers), chunk_size):
+            stop = start + chunk_size
+            sums, counts = self._windowed_sums( img_cumsum, pix_cumsum, 
+                                            centers[start:stop], rmin, rmax)
+            np.divide( sums, counts, out=profiles[start:stop], 
+                        where=counts > 0)
+        return profiles
+
+    @staticmethod
+    def _row_cumsum( img):
+#       cumulative sum along each row, with a leading column of zeros
+        img = np.asarray( img, dtype=float)
+        img_cumsum = np.zeros( (img.shape[0], img.shape[1]+1) )
+        np.cumsum( img, axis=1, out=img_cumsum[:,1:])
+        return img_cumsum
+
+    @staticmethod
+    def _windowed_sums( img_cumsum, pix_cumsum, centers, rmin, rmax):
+        Ydim, Xdim = img_cumsum.shape[0], img_cumsum.shape[1]-1
+        x_center = centers[:,0][:,None,None]
+        y_center = centers[:,1][:,None,None]
+
+#       rows that can intersect the window for any of the centers
+        row_start = max( 0, int( np.floor( centers[:,1].min() - rmax)))
+        row_stop = min( Ydim, int( np.ceil( centers[:,1].max() + rmax)) + 1)
+        rows = np.arange( row_start, row_stop)
+        
+#       half-width of the disk of radius r on each row, for the bin
+#       edges r = rmin..rmax
+        edges = np.arange( rmin, rmax+1, dtype=float)
+        dy = rows[None,:,None] - y_center
+        half_width = np.sqrt( np.maximum( edges**2 - dy*dy, 0) )
+
+#       columns right of the center with radius < r are [split, right),
+#       columns left of it with radius < r are [left, split)
+        split = np.clip( np.ceil( x_center), 0, Xdim)
+        right = np.clip( np.ceil( x_center + half_width), split, Xdim)
+        left = np.clip( np.floor( x_center - half_width) + 1, 0, split)
+        right = right.astype( int)
+        left = left.astype( int)
+
+        row_offset = ( rows * (Xdim+1) )[None,:,None]
+        
+#       totals inside each disk edge, summed over the rows first; the
+#       bins are the differences between consecutive edges
+        def bin_totals( cumsum):
+            cumsum = cumsum.ravel()
+            inside = cumsum[ row_offset + right] - cumsum[ row_offset + left]
+            return np.diff( inside.sum(1), axis=1)
+
+        sums = bin_totals( img_cumsum)
+        if pix_cumsum is None:
+            counts = np.diff( (right - left).sum(1), axis=1)
+        else:
+            counts = bin_totals( pix_cumsum)
+        return sums, counts
+
+    def calculate_stats(self, img, stats=('mean','std','max','min'), 
+                            percentiles=()):
+        """
+        img:    2-dimensional image to be radially binned
+        stats:  names of the statistics to compute over the unmasked pixels 
+                of each radial bin, any of 'count', 'sum', 'sumsq', 'mean', 
+                'std', 'max', 'min' and 'median'
+        percentiles: sequence of percentiles (0-100) to compute in each 
+                radial bin, interpolated the same way as np.percentile
+        
+        returns a dictionary mapping each name in stats to a 1-dimensional 
+        radial profile, plus 'percentiles' (num_percentiles x num_bins) if 
+        any were requested. Radial bins without pixels are 0.
+
+        All the statistics come from one gather of the image in radial 
+        order, followed by segment reductions (np.ufunc.reduceat) over the 
+        runs of equal radius; medians and percentiles partition each run.
+        """
+        self._check_stat_segments()
+        vals = img.ravel()[ self._stat_idx].astype( np.float64)
+        num_bins = max( self.minlength, self.R1.max()+1)
+        starts = self._stat_starts
+        counts = self._stat_counts
+        
+        def full_profile(seg_vals):
+            profile = np.zeros( num_bins)
+            profile[ self._stat_bins] = seg_vals
+            return profile
+        
+        seg_stats = {'count': counts}
+        if set( stats) & set( ['sum', 'mean', 'std']):
+            seg_stats['sum'] = np.add.reduceat( vals, starts)
+            seg_stats['mean'] = seg_stats['sum'] / counts
+        if set( stats) & set( ['sumsq', 'std']):
+            seg_stats['sumsq'] = np.add.reduceat( vals*vals, starts)
+        if 'std' in stats:
+            var = seg_stats['sumsq'] / counts - seg_stats['mean']**2
+            seg_stats['std'] = np.sqrt( np.maximum( var, 0) )
+        if 'max' in stats:
+            seg_stats['max'] = np.maximum.reduceat( vals, starts)
+        if 'min' in stats:
+            seg_stats['min'] = np.minimum.reduceat( vals, starts)
+        if 'median' in stats:
+            seg_stats['median'] = self._segment_percentiles( vals, [50])[0]
+
+        results = {}
+        for name in stats:
+            assert( name in seg_stats)
+            results[name] = full_profile( seg_stats[name])
+        if len( percentiles):
+            seg_pcts = self._segment_percentiles( vals, percentiles)
+            results['percentiles'] = np.array( [ full_profile(p) 
+                                                for p in seg_pcts] )
+        return results
+
+    def _segment_percentiles(self, vals, percentiles):
+        q = np.asarray( percentiles, dtype=float) / 100.
+        assert( np.all( q >= 0) and np.all( q <= 1) )
+        stops = np.append( self._stat_starts[1:], len(vals))
+        seg_pcts = np.zeros( (len(q), len(self._stat_starts)) )
+        for i_seg, (b1, b2) in enumerate( zip( self._stat_starts, stops)):
+            pos = q * (b2 - b1 - 1)
+            lo = np.floor( pos).astype(int)
+            hi = np.ceil( pos).astype(int)
+#           only the order statistics at lo and hi are needed
+            part = np.partition( vals[b1:b2], np.union1d( lo, hi) )
+            seg_pcts[:, i_seg] = part[lo] + ( part[hi] - part[lo] ) * (pos - lo)
+        return seg_pcts
+
     def calculate2(self, img, how="mean", bins=None):
         """
         img:   2-dimensional image to be radially binned
@@ -88,14 +347,8 @@ class RadialProfile:
         returns the 1-dimensional radial profile of img
         """
         if how=="mean":
-            if self.mask is None:
-                summed_intensity_per_radial_bin = np.bincount( self.R.ravel(), 
-                                                    weights=img.ravel(), 
-                                                    minlength=self.minlength)
-            else:
-                summed_intensity_per_radial_bin = np.bincount( self.R.ravel(), 
-                                                    weights=(self.mask*img).ravel(), 
-                                                    minlength=self.minlength)
+            summed_intensity_per_radial_bin = \
+                                self._summed_intensity_per_radial_bin( img)
 
             radial_profile = summed_intensity_per_radial_bin / \
                                 self.num_pixels_per_radial_bin
@@ -103,18 +356,17 @@ class RadialProfile:
             if bins is not None:
                 result =  binned_statistic( self.R.ravel(), values=img.ravel(), 
                                                 bins=bins, statistic='max' )
+                radial_profile = result.statistic
             else:
-                result =  binned_statistic( self.R.ravel(), values=img.ravel(), 
-                                                bins=self.Rbins, statistic='max' )
-            radial_profile = result.statistic
+#               same bins as binned_statistic with bins=self.Rbins, whose 
+#               last bin also holds the largest radius
+                radial_profile = self._max_per_radial_bin( img)
+                radial_profile[-2] = np.fmax( radial_profile[-2], 
+                                                radial_profile[-1])
+                radial_profile = radial_profile[:-1]
         
         elif how=='fast_max':
-            I1d = img.ravel()
-            #Nbin = len( self.sort_idx)
-            #radial_profile = np.zeros( Nbin)
-            radial_profile = [] 
-            for i_b,(b1,b2) in enumerate(zip( self.Rsort_bin_edge[:-1], self.Rsort_bin_edge[1:])):
-                radial_profile.append( max( I1d[ self.sort_idx[b1:b2] ] )) 
+            radial_profile = self._fast_max( img)
 
         else:
             print("how must be mean, max or fast_max")
@@ -122,12 +374,29 @@ class RadialProfile:
 
         return np.nan_to_num(radial_profile)
 
+    def _max_per_radial_bin(self, img):
+#       maximum over all pixels of each radius in self.Rbins, nan where 
+#       there are no pixels
+        self._check_R_sorted_idx()
+        I1d = img.ravel()[ self.sort_idx]
+        radial_profile = np.full( len( self.Rbins), np.nan)
+        radial_profile[ self._Rsort_bins] = np.maximum.reduceat( I1d, 
+                                                    self._Rsort_starts)
+        return radial_profile
+
+    def _fast_max(self, img):
+#       maximum of every run of equal radius, over all pixels
+        self._check_R_sorted_idx()
+        I1d = img.ravel()[ self.sort_idx]
+        return np.maximum.reduceat( I1d, self.Rsort_bin_edge[:-1]).astype(float)
+
     def calculate_using_fetch( self, img, radii, wavelen=None, 
             detdist=None, pixsize=None, factor=None, 
             q_resolution=.01, phi_resolution=10,index_query_fname=None):
         """
         Calculates a radial profile using a much slower method that 
-        adjusts the output for solid angle
+        adjusts the output for solid angle (see set_integrator and 
+        integrate for a fast alternative)
         """
 
         if index_query_fname is None:
@@ -177,15 +446,132 @@ class RadialProfile:
         rings.mask = np.isnan(rings.data)
         return rings.mean(1)
 
+    def set_integrator( self, edges, in_q=False, solid_angle=True, 
+                            polarization_factor=None):
+        """
+        Precompute a split-pixel radial integrator, see integrate
+
+        edges:  bin edges of the profile, in pixel radius units, or in 
+                inverse angstroms if in_q
+        in_q:   whether edges are momentum transfer magnitudes
+        solid_angle: whether to weight each pixel by the solid angle 
+                factor, cos(theta)**3, as in RingFetch
+        polarization_factor: None to skip the polarization correction, 
+                otherwise the fraction of horizontal polarization (-1 to 1),
+                each pixel is divided by its polarization factor 
+
+        in_q, solid_angle and polarization_factor require set_params 
+
+        Each pixel is spread uniformly over its range of radii (the radii 
+        spanned by its area), so it contributes to every bin that range 
+        overlaps in proportion to the overlap. The split fractions, the 
+        mask, the corrections and the per-bin normalization are baked into 
+        one sparse (num_bins x num_pixels) matrix.
+        """
+        self._integrator_params = ( np.asarray( edges, dtype=float), in_q, 
+                                    solid_angle, polarization_factor)
+        self._set_integrator_operator()
+
+    def integrate( self, img):
+        """
+        img:   2-dimensional image, or a 3-dimensional stack of images
+
+        returns the split-pixel, corrected radial profile of img, with the 
+        bins given to set_integrator (num_bins, or num_shots x num_bins), 
+        in units of the photon conversion factor if one was set
+        """
+        assert( self._integrator_params is not None)
+        if self._integrator_op is None:
+            self._set_integrator_operator()
+        if img.ndim == 2:
+            profile = self._integrator_op.dot( img.ravel())
+        else:
+            profile = self._integrator_op.dot( 
+                        img.reshape( (img.shape[0], -1) ).T).T
+        if self.factor is not None:
+            profile = profile * self.factor
+        return np.nan_to_num( profile)
+
+    def _set_integrator_operator( self):
+        edges, in_q, solid_angle, polarization_factor = self._integrator_params
+        assert( np.all( np.diff( edges) > 0) )
+        if in_q or solid_angle or polarization_factor is not None:
+            assert( None not in [self.wavelen, self.detdist, self.pixsize] )
+
+        dy, dx = self._pixel_offsets()
+        dx = np.broadcast_to( dx, self.img_shape).ravel()
+        dy = np.broadcast_to( dy, self.img_shape).ravel()
+        pix = np.arange( dx.size)
+        if self.mask is not None:
+            pix = pix[ self.mask.ravel()[pix].astype(bool) ]
+        dx, dy = dx[pix], dy[pix]
+
+#       smallest and largest radius covered by each pixel
+        r_lo = np.sqrt( np.maximum( np.abs(dx) - 0.5, 0)**2 + 
+                        np.maximum( np.abs(dy) - 0.5, 0)**2 )
+        r_hi = np.sqrt( (np.abs(dx) + 0.5)**2 + (np.abs(dy) + 0.5)**2 )
+        if in_q:
+            r_lo, r_hi = self._r2q( r_lo), self._r2q( r_hi)
+        
+        inside = (r_hi > edges[0]) & (r_lo < edges[-1])
+        pix, dx, dy = pix[inside], dx[inside], dy[inside]
+        r_lo, r_hi = r_lo[inside], r_hi[inside]
+
+        weights = np.ones( len(pix))
+        if solid_angle or polarization_factor is not None:
+            two_theta = np.arctan( np.sqrt( dx**2 + dy**2) * self.pixsize \
+                                    / self.detdist)
+        if solid_angle:
+            weights *= np.cos( two_theta / 2.)**3
+        if polarization_factor is not None:
+            cos_2phi = np.cos( 2 * np.arctan2( dy, dx) )
+            polarization = 0.5 * ( 1 + np.cos( two_theta)**2 - \
+                        polarization_factor * cos_2phi * np.sin( two_theta)**2 )
+            weights /= polarization
+
+#       split each pixel across the bins its radial range overlaps
+        first_bin = np.maximum( np.searchsorted( edges, r_lo, 'right') - 1, 0)
+        last_bin = np.minimum( np.searchsorted( edges, r_hi, 'left') - 1, 
+                                len(edges) - 2)
+        rows, cols, fracs, weighted_fracs = [], [], [], []
+        for offset in range( int( (last_bin - first_bin).max()) + 1):
+            b = first_bin + offset
+            use = b <= last_bin
+            overlap = np.minimum( edges[ b[use] + 1], r_hi[use]) - \
+                        np.maximum( edges[ b[use] ], r_lo[use])
+            rows.append( b[use])
+            cols.append( pix[use])
+            fracs.append( overlap / ( r_hi[use] - r_lo[use] ) )
+            weighted_fracs.append( fracs[-1] * weights[use] )
+        rows = np.concatenate( rows)
+        cols = np.concatenate( cols)
+        fracs = np.concatenate( fracs)
+        weighted_fracs = np.concatenate( weighted_fracs)
+        
+#       normalize by the (fractional) number of pixels in each bin
+        num_bins = len(edges) - 1
+        bin_pixels = np.bincount( rows, weights=fracs, minlength=num_bins)
+        vals = weighted_fracs / bin_pixels[rows]
+        self._integrator_op = sparse.csr_matrix( (vals, (rows, cols)), 
+                                    shape=(num_bins, self.R.size) )
+
+    def _r2q( self, R):
+#       same conversion as RingFetch.r2q
+        return np.sin( np.arctan( R * self.pixsize / self.detdist) / 2.) \
+                        * 4 * np.pi / self.wavelen
+
     def update_center( self, new_center):
         self.x_center = new_center[0]
         self.y_center = new_center[1]
         self._set_R()
         self._set_normalization()
+        self._integrator_op = None
 
     def set_params( self, wavelen, detdist, pixsize, factor):
         self.wavelen = wavelen
         self.detdist = detdist
         self.pixsize = pixsize
         self.factor = factor
+#       the integrator depends on the geometry
+        self._integrator_op = None
 
@@ -1,14 +1,24 @@
-import h5py
+import os
+
 import numpy as np
-from scipy.ndimage import zoom
 from scipy import spatial
+from scipy import sparse
+
+from loki.RingData.GeometryCache import GeometryCache
+from loki.RingData.RingIndexFile import RingIndexFile
 
 class RingFetch:
 
+    _max_cached_operators = 1024
+    _max_cached_centers = 32
+    _gap_filler_names = ('fill_inds', 'fill_gap', 'fill_frac',
+                         'left_op', 'right_op')
+
     def __init__(self, a, b, img_shape=None, img=None, mask=None, q_resolution=0.05,
                  phi_resolution=0.5, wavelen=None, pixsize=None,
                  detdist=None, photon_conversion_factor=1,
-                 interp_method='floor', index_query_fname=None):
+                 interp_method='floor', index_query_fname=None, rng=None,
+                 cache_dir=None):
         '''
         Description
         ===========
@@ -36,9 +46,23 @@ class RingFetch:
 
         `photon_conversion_factor`
 
-        `interp_method`
+        `interp_method` is how the polar samples are taken from the image,
+            one of 'floor', 'nearest', 'nearest4', 'weighted4' or 'count'.
+            'count' samples like 'floor' but, instead of filling masked
+            regions with noise, returns the summed unmasked intensity of
+            each phi-node along with the (fractional) number of unmasked
+            samples that went into it
 
         `index_query_fname`
+
+        `rng` is a seed or a numpy.random.Generator used to draw the noise
+            that fills in masked regions of the rings
+
+        `cache_dir` is an optional directory where the precomputed ring
+            operators are stored and re-used across jobs that share the
+            same geometry and mask (see GeometryCache). Only the
+            operators of the center (`a`, `b`) are stored, not those of
+            centers moved to with set_center
         '''
 
         self.x_center = a
@@ -46,7 +70,13 @@ class RingFetch:
         
         assert( img_shape is not None or img is not None)
 
-        assert(interp_method in ['floor', 'nearest', 'nearest4', 'weighted4'])
+        self._ring_operators = {}
+        self._radial_samples = {}
+        self._center_operators = {}
+        self.set_rng(rng)
+
+        assert(interp_method in ['floor', 'nearest', 'nearest4', 'weighted4',
+                                 'count'])
         self.method = interp_method
         
         if img is not None:
@@ -63,18 +93,12 @@ class RingFetch:
 
         if self.method in ['nearest', 'nearest4', 'weighted4']:
             assert(index_query_fname is not None)
-            query_file = h5py.File(index_query_fname, 'r')
-            self._max_radius_in_query_data = max(
-                list(map(int, query_file['nearest/dists'].keys())))
-            if self.method == 'nearest':
-                self._index_data = query_file['nearest']
-            else:
-                self._index_data = query_file['nearest4']
+            self._load_index_data(index_query_fname)
+            self._max_radius_in_query_data = self._index_radii.max()
 
         if mask is not None:
             assert(mask.shape == self.img_shape)
-            if self.method != 'floor':
-                self._mask_flat = mask.ravel()
+            self._mask_flat = mask.ravel().astype(bool)
         self.mask = mask
 
         self._set_max_ring_radius()
@@ -87,6 +111,49 @@ class RingFetch:
         self.detdist = detdist
         self.photon_conversion_factor = photon_conversion_factor
 
+        if cache_dir is not None:
+            self._geometry_cache = GeometryCache(cache_dir)
+            self._set_geometry_id(index_query_fname)
+            self._cached_center = (a, b)
+        else:
+            self._geometry_cache = None
+
+    def _set_geometry_id(self, index_query_fname):
+        if self.method in ['floor', 'count']:
+            index_id = None
+        else:
+            index_id = (os.path.abspath(index_query_fname),
+                        os.path.getsize(index_query_fname),
+                        os.path.getmtime(index_query_fname))
+        self._geometry_id = GeometryCache.make_key(
+            float(self.x_center), float(self.y_center),
+            tuple(int(d) for d in self.img_shape), self.method, index_id,
+            float(self.phi_resolution), self.mask)
+
+    def _load_index_data(self, index_query_fname):
+        """
+        Reads the ring index data for every radius once, into CSR-style
+        arrays: the samples of radius self._index_radii[i] are rows
+        self._index_offsets[i]:self._index_offsets[i+1] of the
+        (num_samples x k) arrays self._index_inds and self._index_weights
+        """
+        index_file = RingIndexFile(index_query_fname)
+        if self.method == 'nearest':
+            offsets, dists, inds = index_file.load('nearest')
+        else:
+            offsets, dists, inds = index_file.load('nearest4')
+
+        self._index_radii = index_file.radii
+        self._index_offsets = offsets
+        self._index_inds = inds.reshape((offsets[-1], -1))
+
+        if self.method == 'weighted4':
+            dists = np.asarray(dists)
+            self._index_weights = dists / dists.sum(1)[:, None]
+        else:
+            k = self._index_inds.shape[1]
+            self._index_weights = np.ones(self._index_inds.shape) / k
+
     def _set_conversion_functions(self):
         #       convert pixel radius to q
         self.r2q = lambda R: np.sin(np.arctan(
@@ -108,8 +175,7 @@ class RingFetch:
     def set_working_image(self, img):
         assert (img.shape == self.img_shape)
         self.img = img
-        if self.method != 'floor':
-            self._img_flat = img.ravel()
+        self._img_flat = img.ravel()
 
     def set_params(self, wavelen, detdist):
         self.wavelen = wavelen
@@ -124,9 +190,35 @@ class RingFetch:
         self.detdist = detdist
         self._set_conversion_functions()
 
+    def set_center(self, a, b):
+        """
+        Moves the forward beam position to (`a`, `b`). The ring operators
+        depend on the center; those of the last `_max_cached_centers`
+        centers are kept in memory, so shots that return to a center
+        re-use them, and the others are rebuilt when next needed. Only
+        'floor' and 'count' sampling can follow the center, the other
+        methods read indices that loki.queryRingIndices computed for one
+        center.
+        """
+        if (a, b) == (self.x_center, self.y_center):
+            return
+        assert(self.method in ['floor', 'count'])
+        if len(self._center_operators) >= self._max_cached_centers:
+            self._center_operators.clear()
+        self._center_operators[(self.x_center, self.y_center)] = \
+            (self._ring_operators, self._radial_samples)
+        self.x_center = a
+        self.y_center = b
+        self._ring_operators, self._radial_samples = \
+            self._center_operators.pop((a, b), ({}, {}))
+        self._set_max_ring_radius()
+
     def set_photon_factor(self, factor):
         self.photon_conversion_factor = factor
 
+    def set_rng(self, rng):
+        self.rng = np.random.default_rng(rng)
+
 ###############
 # MAIN METHOD #
 ###############
@@ -152,227 +244,469 @@ class RingFetch:
 
         `polar_ring_final` is the corresponding intensities in the
             effective pixels
+
+        If interp_method is 'count', returns a tuple of the summed
+            unmasked intensities and the number of unmasked samples
         '''
-        assert(self.wavelen is not None and self.detdist is not None)
         assert( q is not None or radius is not None)
         assert ( None in [ q, radius] )
-        self._define_radial_extent_of_ring(q, radius)
+        if q is not None:
+            rings = self.fetch_rings(qs=[q], solid_angle=solid_angle)
+        else:
+            rings = self.fetch_rings(radii=[radius], solid_angle=solid_angle)
+        if self.method == 'count':
+            return rings[0][0], rings[1][0]
+        return rings[0]
+
+    def fetch_rings(self, qs=None, radii=None, solid_angle=True):
+        '''
+        Fetch several rings at once. Neighbouring rings whose radial
+        extents overlap share the polar samples (and the filled-in masked
+        values) of their common radii.
+
+        Parameters
+        ==========
+
+        `qs` is a list of moementum transfer magnitudes of the rings
+            in inverse angstroms
+
+        `radii` is a list of ring radii in pixel units
+
+        `solid_angle` is whether or not to do the solid angle correction
+
+        Returns
+        =======
+
+        2D array of shape (num_rings x num_phi_nodes), the intensities
+            in the effective pixels of each ring
+
+        If interp_method is 'count', returns a tuple of the summed
+            unmasked intensities and the number of unmasked samples,
+            both of shape (num_rings x num_phi_nodes)
+        '''
+        assert(self.wavelen is not None and self.detdist is not None)
+        assert( (qs is None) != (radii is None) )
+        self._define_radial_extent_of_rings(qs, radii)
         self._check_ring_edges()
-        self._make_output_containers()
-        self._iterate_across_ring_extent()
-        if solid_angle:
-            self._solid_angle_correction()
-        self._adjust_fractional_rings()
-        return self._ring_output.sum(0)
+        self._set_ring_operator(solid_angle)
+        rings = self._apply_ring_operator(self._img_flat)
+        rings = rings.reshape((self._nring, self.num_phi_nodes))
+        if self.method == 'count':
+            return rings, self._get_counts()
+        return rings
 
-    def _define_radial_extent_of_ring(self, q, radius):
-        if radius is None:
-            q_of_ring = q
+    def fetch_rings_stack(self, stack, qs=None, radii=None, solid_angle=True,
+                          out=None, chunk_size=100):
+        '''
+        Fetch the same rings from every image in a stack of images
+
+        Parameters
+        ==========
+
+        `stack` is a 3D array of images (num_shots x Y x X), or anything
+            that can be sliced like one, e.g. an h5py dataset
+
+        `qs`, `radii`, `solid_angle` are as in `fetch_rings`
+
+        `out` is an optional pre-allocated output array of shape
+            (num_shots x num_rings x num_phi_nodes)
+
+        `chunk_size` is how many images are read from `stack` and
+            interpolated per matrix multiply
+
+        Returns
+        =======
+
+        `out`, the array of ring intensities for each image
+
+        If interp_method is 'count', returns a tuple of `out` and the
+            number of unmasked samples (num_rings x num_phi_nodes),
+            which is the same for every image
+        '''
+        assert(self.wavelen is not None and self.detdist is not None)
+        assert( (qs is None) != (radii is None) )
+        assert(tuple(stack.shape[1:]) == tuple(self.img_shape))
+        self._define_radial_extent_of_rings(qs, radii)
+        self._check_ring_edges()
+        self._set_ring_operator(solid_angle)
+
+        num_shots = stack.shape[0]
+        out_shape = (num_shots, self._nring, self.num_phi_nodes)
+        if out is None:
+            out = np.zeros(out_shape)
+        assert(out.shape == out_shape)
+
+        for start in range(0, num_shots, chunk_size):
+            stop = min(start + chunk_size, num_shots)
+            chunk = np.asarray(stack[start:stop])
+            flat_chunk = chunk.reshape((stop - start, -1))
+            rings = self._apply_ring_operator(flat_chunk.T)
+            out[start:stop] = rings.T.reshape((stop - start,
+                                               self._nring,
+                                               self.num_phi_nodes))
+        if self.method == 'count':
+            return out, self._get_counts()
+        return out
+
+    def _get_counts(self):
+        return np.array(self._sample_counts).reshape(
+            (self._nring, self.num_phi_nodes))
+
+    def _define_radial_extent_of_rings(self, qs, radii):
+        if radii is None:
+            q_of_rings = np.asarray(qs, dtype=float)
         else:
-            q_of_ring = self.r2q(radius)
-#       min q for ring at desired resolution
-        qmin = q_of_ring - self.q_resolution / 2.
-#       max q for ring at desired resolution
-        qmax = q_of_ring + self.q_resolution / 2.
+            q_of_rings = self.r2q(np.asarray(radii, dtype=float))
+#       min q for rings at desired resolution
+        qmin = q_of_rings - self.q_resolution / 2.
+#       max q for rings at desired resolution
+        qmax = q_of_rings + self.q_resolution / 2.
 #       qmin/qmax in radial pixle units
-        self._rmin = self.q2r(qmin)
-        self._rmax = self.q2r(qmax)
-        assert(self._rmax - 1. > self._rmin)
+        self._rmins = self.q2r(qmin)
+        self._rmaxs = self.q2r(qmax)
+        assert(np.all(self._rmaxs - 1. > self._rmins))
 
-        self._radii = np.arange(int(self._rmin), int(self._rmax) + 1)
+        self._ring_radii = [np.arange(int(rmin), int(rmax) + 1)
+                            for rmin, rmax in zip(self._rmins, self._rmaxs)]
+        self._radii = np.unique(np.concatenate(self._ring_radii))
         self._nrad = len(self._radii)
+        self._nring = len(self._rmins)
 
     def _check_ring_edges(self):
-        nphi_min = int(2 * np.pi * self._rmin)
-        assert(nphi_min >= self.num_phi_nodes)
-        assert(int(self._rmax) + 1 < self._maximum_allowable_ring_radius)
-        if self.method != 'floor':
-            assert(int(self._rmax) + 1 < self._max_radius_in_query_data)
-
-    def _make_output_containers(self):
-        self._ring_output = np.zeros((self._nrad, self.num_phi_nodes))
-
-    def _iterate_across_ring_extent(self):
-        for self._rad_ind, radius in enumerate(self._radii):
-            #           number of azimuthal points in radial image
-            self._nphi = int(2 * np.pi * radius)
-            if self.method == 'floor':
-                self.InterpSimp = InterpSimple(
-                    self.x_center,
-                    self.y_center,
-                    radius + 1,
-                    radius,
-                    self._nphi,
-                    raw_img_shape=self.img.shape)
-                self._set_polar_ring()
-
-            elif self.method == 'nearest':
-                self._set_polar_ring_mean_nearest(radius)
-
-            elif self.method == 'nearest4':
-                self._set_polar_ring_mean_nearest4(radius)
-
-            else:
-                self._set_polar_ring_weighted_nearest4(radius)
-
-            self._fill_in_masked_values()
-            self._sum_intensity_in_azimuthal_nodes()
-
-    def _solid_angle_correction(self):
-        theta_vals = self.r2theta(self._radii)
-        solid_angle_per_radii = np.cos(theta_vals) ** 3
-        self._ring_output *= solid_angle_per_radii[:, None]
-
-    def _adjust_fractional_rings(self):
-        start_factor = 1. - self._rmin + np.floor(self._rmin)
-        stop_factor = self._rmax - np.floor(self._rmax)
-        self._ring_output[0] *= start_factor
-        self._ring_output[-1] *= stop_factor
-
-    def _set_polar_ring_weighted_nearest4(self, radius):
-        dists, inds = self._index_data["dists/%d" % radius].value,\
-            self._index_data["inds/%d" % radius].value,
-        weights = dists / dists.sum(1)[:, None]
-        self._polar_ring = np.average(
-            self._img_flat[inds], axis=1, weights=weights)
-        if self.mask is not None:
-            self._polar_ring_mask = np.average(
-                self._mask_flat[inds], axis=1, weights=weights)
-            self._polar_ring_mask = self._polar_ring_mask.astype(int)
+        nphi_min = (2 * np.pi * self._rmins).astype(int)
+        assert(np.all(nphi_min >= self.num_phi_nodes))
+        assert(np.all(self._rmaxs.astype(int) + 1 <
+                      self._maximum_allowable_ring_radius))
+        if self.method in ['nearest', 'nearest4', 'weighted4']:
+            assert(np.all(self._rmaxs.astype(int) + 1 <
+                          self._max_radius_in_query_data))
+
+    def _radial_factors(self, i_ring, solid_angle):
+        rmin = self._rmins[i_ring]
+        rmax = self._rmaxs[i_ring]
+        ring_radii = self._ring_radii[i_ring]
+        factors = np.ones(len(ring_radii))
+#       fractional first and last rings
+        factors[0] *= 1. - rmin + np.floor(rmin)
+        factors[-1] *= rmax - np.floor(rmax)
+        if solid_angle:
+            theta_vals = self.r2theta(ring_radii)
+            factors *= np.cos(theta_vals) ** 3
+        return factors
+
+##################################
+# PRECOMPUTED RING OPERATORS     #
+##################################
+    def _set_ring_operator(self, solid_angle):
+        """
+        The ring operator depends only on the geometry, so it is built
+        once per set of radial extents and re-used for every shot
+        """
+        key = (tuple(self._rmins), tuple(self._rmaxs),
+               self.detdist, self.pixsize, solid_angle)
+        if key not in self._ring_operators:
+            if len(self._ring_operators) >= self._max_cached_operators:
+                self._ring_operators.clear()
+            self._ring_operators[key] = \
+                self._load_or_make_ring_operator(solid_angle)
+        self._gather_op, self._reduce_op, self._ring_op, \
+            self._sample_offsets, self._gap_filler, self._sample_counts = \
+            self._ring_operators[key]
+
+    def _load_or_make_ring_operator(self, solid_angle):
+#       per-shot centers (see set_center) are not stored on disk
+        if self._geometry_cache is None or \
+                (self.x_center, self.y_center) != self._cached_center:
+            return self._make_ring_operator(solid_angle)
+
+        cache_key = GeometryCache.make_key(
+            'RingFetch', self._geometry_id, self._rmins, self._rmaxs,
+            float(self.detdist), float(self.pixsize), solid_angle)
+        arrays = self._geometry_cache.load(cache_key)
+        if arrays is not None:
+            return self._ring_operator_from_arrays(arrays)
+
+        operator = self._make_ring_operator(solid_angle)
+        self._geometry_cache.save(cache_key,
+                                  self._ring_operator_to_arrays(operator))
+        return operator
+
+    def _ring_operator_to_arrays(self, operator):
+        gather, summation, combined, offsets, gap_filler, counts = operator
+        arrays = {'gather': gather,
+                  'summation': summation,
+                  'combined': combined,
+                  'offsets': offsets}
+        if gap_filler is not None:
+            arrays.update(zip(self._gap_filler_names, gap_filler))
+        if counts is not None:
+            arrays['counts'] = counts
+        return arrays
+
+    def _ring_operator_from_arrays(self, arrays):
+        if 'fill_inds' in arrays:
+            gap_filler = tuple(arrays[name] for name in self._gap_filler_names)
+        else:
+            gap_filler = None
+        return (arrays['gather'], arrays['summation'], arrays['combined'],
+                arrays['offsets'], gap_filler, arrays.get('counts'))
 
-    def _set_polar_ring_mean_nearest4(self, radius):
-        inds = self._index_data["inds/%d" % radius].value,
-        self._polar_ring = self._img_flat[inds].mean(1)
-        if self.mask is not None:
-            self._polar_ring_mask = self._mask_flat[inds].mean(1)
-            self._polar_ring_mask = self._polar_ring_mask.astype(int)
+    def _make_ring_operator(self, solid_angle):
+        """
+        Returns
+        =======
+        `gather` sparse matrix mapping flattened detector pixels to the
+            polar samples of each integer radius spanned by the rings
+
+        `summation` sparse matrix mapping polar samples to the
+            (ring, phi-node) bins, including fractional edge weights,
+            fractional first/last ring factors and (optionally) the
+            solid angle factor
+
+        `combined` the product summation * gather, mapping pixels to
+            (ring, phi-node) bins
+
+        `offsets` where the polar samples of each radius start and stop
+
+        `gap_filler` the precomputed masked gaps of the samples
+            (None if there are no masked samples)
+
+        `counts` for interp_method 'count', the number of unmasked
+            samples in each (ring, phi-node) bin, weighted by the
+            fractional edge and ring factors (None otherwise). In this
+            case `combined` only sums the unmasked samples.
+        """
+        inds, weights = [], []
+        offsets = [0]
+        node_weights = []
+        for radius in self._radii:
+            ring_inds, ring_weights = self._get_radial_samples(radius)
+            nphi = ring_inds.shape[0]
+            node_weights.append(self._azimuthal_node_weights(nphi))
+            inds.append(ring_inds)
+            weights.append(ring_weights)
+            offsets.append(offsets[-1] + nphi)
+
+        rows, cols, vals, count_vals = [], [], [], []
+        for i_ring in range(self._nring):
+            radial_factors = self._radial_factors(i_ring, solid_angle)
+            count_factors = self._radial_factors(i_ring, False)
+            rad_inds = np.searchsorted(self._radii, self._ring_radii[i_ring])
+            for i, i_rad in enumerate(rad_inds):
+                node_rows, node_cols, node_vals = node_weights[i_rad]
+                rows.append(node_rows + i_ring * self.num_phi_nodes)
+                cols.append(node_cols + offsets[i_rad])
+                vals.append(node_vals * radial_factors[i])
+                count_vals.append(node_vals * count_factors[i])
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+
+        inds = np.vstack(inds)
+        weights = np.vstack(weights)
+        num_samples, k = inds.shape
+        gather = sparse.csr_matrix(
+            (weights.ravel(), inds.ravel(), np.arange(0, num_samples*k+1, k)),
+            shape=(num_samples, int(np.prod(self.img_shape))))
+        summation = sparse.csr_matrix(
+            (np.concatenate(vals), (rows, cols)),
+            shape=(self._nring * self.num_phi_nodes, num_samples))
 
-    def _set_polar_ring_mean_nearest(self, radius):
-        inds = self._index_data["inds/%d" % radius].value,
-        self._polar_ring = self._img_flat[inds]
         if self.mask is not None:
-            self._polar_ring_mask = self._mask_flat[inds]
-
-################################
-# RING RADII ITERATION METHODS #
-################################
-    def _set_polar_ring(self):
-        polar_img = self.InterpSimp.nearest(self.img)
-        self._polar_ring = polar_img[0]
-
-    def _fill_in_masked_values(self):
-        if self.mask is not None and self.method == 'floor':
-            #           interpolate the polar mask
-            polar_mask = self.InterpSimp.nearest(self.mask.astype(int))
-            self._polar_ring_mask = polar_mask[0]
-
-        self._fill_polar_ring()
-
-    def _sum_intensity_in_azimuthal_nodes(self):
-        node_edges = np.linspace(
-            0,
-            self._nphi,
-            self.num_phi_nodes +
-            1)  # fractional pixels
-        node_inds = node_edges.astype(int)
-        frac_start = (1 - node_edges + np.floor(node_edges))[:-1]
-        frac_stop = (node_edges - np.floor(node_edges))[1:]
-        for i in xrange(self.num_phi_nodes - 1):
-            start = node_inds[i]
-            stop = node_inds[i + 1]
-            summed_intens = self._polar_ring[start] * frac_start[i] \
-                + np.sum(self._polar_ring[start + 1:stop])\
-                + self._polar_ring[stop] * frac_stop[i]
-            self._ring_output[self._rad_ind, i] += summed_intens \
-                * self.photon_conversion_factor
-        start = node_inds[-2]
-        self._ring_output[self._rad_ind, -1] += (self._polar_ring[start] * frac_start[-1]
-                                               + np.sum(self._polar_ring[start + 1:]))\
-            * self.photon_conversion_factor
+            sample_mask = self._mask_flat[inds].all(1)
+        else:
+            sample_mask = np.ones(num_samples, dtype=bool)
+
+        offsets = np.array(offsets)
+        gap_filler = None
+        counts = None
+        if self.method == 'count':
+            count_summation = sparse.csr_matrix(
+                (np.concatenate(count_vals), (rows, cols)),
+                shape=summation.shape)
+            counts = count_summation.dot(sample_mask.astype(float))
+            unmasked = sparse.diags(sample_mask.astype(float))
+            combined = summation.dot(unmasked).dot(gather).tocsr()
+        else:
+            combined = summation.dot(gather).tocsr()
+            if not sample_mask.all():
+                gap_filler = self._make_gap_filler(offsets, sample_mask)
+
+        return gather, summation, combined, offsets, gap_filler, counts
+
+    def _get_radial_samples(self, radius):
+        """
+        Returns the pixel indices (num_phi x k) and normalized weights
+        of the polar samples along an integer radius
+        """
+        if radius in self._radial_samples:
+            return self._radial_samples[radius]
+
+        if self.method in ['floor', 'count']:
+            nphi = int(2 * np.pi * radius)
+            interp = InterpSimple(
+                self.x_center,
+                self.y_center,
+                radius + 1,
+                radius,
+                nphi,
+                raw_img_shape=self.img_shape)
+            inds = interp.indices_1d.reshape((nphi, 1))
+            weights = np.ones(inds.shape)
+            self._radial_samples[radius] = (inds, weights)
+            return inds, weights
+
+        i_rad = np.searchsorted(self._index_radii, radius)
+        assert(self._index_radii[i_rad] == radius)
+        start, stop = self._index_offsets[i_rad:i_rad + 2]
+        return self._index_inds[start:stop], self._index_weights[start:stop]
+
+    def _azimuthal_node_weights(self, nphi):
+        """
+        Sparse (row, col, value) triplets that sum `nphi` polar samples
+        into `self.num_phi_nodes` nodes, splitting the samples that
+        straddle a node edge according to their fractional overlap
+        """
+        edges = np.linspace(0, nphi, self.num_phi_nodes + 1)
+        samples = np.arange(nphi)
+        first_node = np.searchsorted(edges, samples, side='right') - 1
+        first_overlap = np.minimum(edges[first_node + 1], samples + 1) - samples
+        remainder = 1. - first_overlap
+        split = remainder > 0
+        rows = np.concatenate((first_node, first_node[split] + 1))
+        cols = np.concatenate((samples, samples[split]))
+        vals = np.concatenate((first_overlap, remainder[split]))
+        return rows, cols, vals
+
+    def _apply_ring_operator(self, img_flat):
+        """
+        `img_flat` is either one flattened image (num_pixels,) or a block
+            of flattened images (num_pixels x num_shots)
+        """
+        if self._gap_filler is None:
+            rings = self._ring_op.dot(img_flat)
+        else:
+            polar_samples = self._gather_op.dot(img_flat)
+            polar_samples = polar_samples.reshape((polar_samples.shape[0], -1))
+            self._fill_masked_samples(polar_samples)
+            rings = self._reduce_op.dot(polar_samples)
+            if img_flat.ndim == 1:
+                rings = rings[:, 0]
+        return rings * self.photon_conversion_factor
 
 ########################################
 # METHODS FOR FILLLING IN MASKED REGIONS
 ########################################
-    def _fill_polar_ring(self):
-        """sample_width in degrees"""
-        self._sample_width = int(
-            round(
-                self._nphi *
-                10 *
-                self.phi_resolution /
-                360.))
-        assert(self._sample_width > 1)
-        self._find_gap_indices()
-        self._set_left_and_right_edge_indices()
-        self._iterate_over_masked_regions()
-
-    def _find_gap_indices(self):
-        mask = self._polar_ring_mask.astype(bool)
-        mask_rolled_right = np.roll(mask, 1)
-        mask_rolled_left = np.roll(mask, -1)
-
-        is_start_of_gap = (mask ^ mask_rolled_left) & mask
-        is_end_of_gap = (mask ^ mask_rolled_right) & mask
-
-        self._gap_start_indices = np.where(is_start_of_gap)[0]
-        self._gap_end_indices = np.where(is_end_of_gap)[0]
-
-    def _set_left_and_right_edge_indices(self):
-        #if self._polar_ring_mask[0] == 0:
-        self._gap_index_pairs = list(zip(self._gap_start_indices,
-            np.roll(self._gap_end_indices, -1)) )
-        #else:
-        #    self._gap_index_pairs = zip(self._gap_start_indices,
-        #                               self._gap_end_indices)
-
-    def _iterate_over_masked_regions(self):
-        
-        for self._iStart, self._iEnd in self._gap_index_pairs:
-            self._set_gap_size_and_ranges()
-            self._get_linear_gap_interpolator()
-            self._get_edge_noise()
-            self._fill_in_masked_region_with_Gaussian_noise()
-
-    def _set_gap_size_and_ranges(self):
-        if self._iEnd < self._iStart:
-            self._gap_size = self._iEnd + self._nphi - self._iStart
-            self._interpolation_range = np.arange(
-                self._iStart, self._iEnd + self._nphi)
-        else:
-            self._gap_size = self._iEnd - self._iStart
-            self._interpolation_range = np.arange(self._iStart, self._iEnd)
-
-    def _get_linear_gap_interpolator(self):
-        #       estimate the edge means
-        left_mean = self._polar_ring[
-            self._iStart - self._sample_width:self._iStart].mean()
-        right_mean = self._polar_ring[
-            self._iEnd +
-            1:self._sample_width +
-            self._iEnd +
-            1].mean()
-
-#       find the equation of line connecting edge means
-        slope = (right_mean - left_mean) / self._gap_size
-        self._line = lambda x: slope * (x - self._iStart) + left_mean
-
-    def _get_edge_noise(self):
-        #       estimate the edge noise
-        left_dev = self._polar_ring[
-            self._iStart - self._sample_width:self._iStart].std()
-        right_dev = self._polar_ring[
-            self._iEnd +
-            1:self._sample_width +
-            self._iEnd +
-            1].std()
-        self._edge_noise = (left_dev + right_dev) / 2.  # np.sqrt(2)
-
-    def _fill_in_masked_region_with_Gaussian_noise(self):
-        #       fill in noise about the line
-        gap_range = self._interpolation_range % self._nphi
-        gap_vals = np.random.normal(self._line(self._interpolation_range),
-                                    self._edge_noise)
-        self._polar_ring[gap_range] = gap_vals
+    def _make_gap_filler(self, offsets, sample_mask):
+        """
+        Locates every masked gap along every radius at once. Each gap is
+        filled with Gaussian noise about the line connecting the means of
+        the unmasked samples on either side of the gap. The edge samples
+        span 10 phi-resolution elements (sample_width, in degrees).
+
+        Returns
+        =======
+        `fill_inds` indices of the masked samples that lie in a gap
+
+        `fill_gap` which gap each of `fill_inds` belongs to
+
+        `fill_frac` fractional position of each of `fill_inds` across its gap
+
+        `left_op`, `right_op` sparse matrices that average the unmasked
+            samples on the left / right edge of each gap
+        """
+        nphis = np.diff(offsets)
+        sample_widths = np.round(nphis * 10 * self.phi_resolution / 360.)
+        sample_widths = sample_widths.astype(int)
+        assert(np.all(sample_widths > 1))
+
+#       which radius each sample is on, and its azimuthal index on that radius
+        sample_rad = np.repeat(np.arange(len(nphis)), nphis)
+        sample_phi = np.arange(offsets[-1]) - offsets[sample_rad]
+        prev_sample = offsets[sample_rad] + (sample_phi - 1) % nphis[sample_rad]
+        next_sample = offsets[sample_rad] + (sample_phi + 1) % nphis[sample_rad]
+
+#       last unmasked sample before a gap, first unmasked sample after a gap
+        gap_starts = np.where(sample_mask & ~sample_mask[next_sample])[0]
+        gap_ends = np.where(sample_mask & ~sample_mask[prev_sample])[0]
+        if gap_starts.size == 0:
+            return None
+
+#       pair each gap start with the next gap end on the same radius,
+#       wrapping around the radius if need be
+        end_pos = np.searchsorted(gap_ends, gap_starts, side='right')
+        end_pos = np.minimum(end_pos, gap_ends.size - 1)
+        wraps = sample_rad[gap_ends[end_pos]] != sample_rad[gap_starts]
+        wraps |= gap_ends[end_pos] < gap_starts
+        first_end_pos = np.searchsorted(gap_ends, offsets[sample_rad[gap_starts]])
+        end_pos[wraps] = first_end_pos[wraps]
+        gap_ends = gap_ends[end_pos]
+
+        gap_rad = sample_rad[gap_starts]
+        gap_nphi = nphis[gap_rad]
+        gap_offset = offsets[gap_rad]
+        gap_start_phi = sample_phi[gap_starts]
+        gap_sizes = (sample_phi[gap_ends] - gap_start_phi) % gap_nphi
+#       a radius with a single unmasked sample is one gap around the ring
+        gap_sizes[gap_sizes == 0] = gap_nphi[gap_sizes == 0]
+        num_gaps = gap_starts.size
+
+#       the masked samples inside each gap
+        num_fill = gap_sizes - 1
+        fill_gap = np.repeat(np.arange(num_gaps), num_fill)
+        fill_step = np.arange(num_fill.sum()) - \
+            np.repeat(np.cumsum(num_fill) - num_fill, num_fill) + 1
+        fill_inds = gap_offset[fill_gap] + \
+            (gap_start_phi[fill_gap] + fill_step) % gap_nphi[fill_gap]
+        fill_frac = fill_step / gap_sizes[fill_gap].astype(float)
+
+#       the unmasked samples on the edges of each gap
+        gap_widths = sample_widths[gap_rad]
+        edge_gap = np.repeat(np.arange(num_gaps), gap_widths)
+        edge_step = np.arange(gap_widths.sum()) - \
+            np.repeat(np.cumsum(gap_widths) - gap_widths, gap_widths)
+        left_inds = gap_offset[edge_gap] + \
+            (gap_start_phi[edge_gap] - edge_step) % gap_nphi[edge_gap]
+        right_inds = gap_offset[edge_gap] + \
+            (sample_phi[gap_ends][edge_gap] + edge_step) % gap_nphi[edge_gap]
+
+        left_op = self._edge_average_operator(
+            edge_gap, left_inds, sample_mask, num_gaps)
+        right_op = self._edge_average_operator(
+            edge_gap, right_inds, sample_mask, num_gaps)
+
+        return fill_inds, fill_gap, fill_frac, left_op, right_op
+
+    @staticmethod
+    def _edge_average_operator(edge_gap, edge_inds, sample_mask, num_gaps):
+        is_unmasked = sample_mask[edge_inds]
+        edge_gap = edge_gap[is_unmasked]
+        edge_inds = edge_inds[is_unmasked]
+        counts = np.bincount(edge_gap, minlength=num_gaps)
+        return sparse.csr_matrix(
+            (1. / counts[edge_gap], (edge_gap, edge_inds)),
+            shape=(num_gaps, sample_mask.size))
+
+    def _fill_masked_samples(self, polar_samples):
+        """
+        Fills the masked gaps of a block of polar samples
+        (num_samples x num_shots) in place
+        """
+        fill_inds, fill_gap, fill_frac, left_op, right_op = self._gap_filler
+
+#       estimate the edge means and the edge noise
+        left_mean = left_op.dot(polar_samples)
+        right_mean = right_op.dot(polar_samples)
+        left_dev = np.sqrt(np.maximum(
+            left_op.dot(polar_samples**2) - left_mean**2, 0))
+        right_dev = np.sqrt(np.maximum(
+            right_op.dot(polar_samples**2) - right_mean**2, 0))
+        edge_noise = (left_dev + right_dev) / 2.
+
+#       fill in noise about the line connecting the edge means
+        line = left_mean[fill_gap] + fill_frac[:, None] * \
+            (right_mean[fill_gap] - left_mean[fill_gap])
+        noise = self.rng.standard_normal(line.shape) * edge_noise[fill_gap]
+        polar_samples[fill_inds] = line + noise
 
 
 class InterpSimple:
@@ -393,7 +727,16 @@ class InterpSimple:
         raw_img_shape - int tuple, ydim, xdim of the raw image
 
         bin_fac       - float, reduce the size of the cartesian image
-                            by this amount
+                            by this amount; each polar pixel is then the
+                            average of the raw pixels inside its binned
+                            pixel. `a`, `b` and the radii are in binned
+                            pixel units of the former ndimage.zoom
+                            resampling, which puts binned pixel j at raw
+                            pixel j * (raw_dim - 1) / (binned_dim - 1);
+                            the polar points are mapped from there onto
+                            the block centers, j * bin_fac +
+                            (bin_fac - 1) / 2, so the sampled geometry
+                            is the same
         '''
         self.x_center = a
         self.y_center = b
@@ -403,11 +746,11 @@ class InterpSimple:
         self.phis_ring = np.arange(nphi) * 2 * np.pi / nphi
         self.num_phis_ring = nphi
 
-        self.y_centerin_fac = bin_fac
+        self.bin_fac = bin_fac
 
         if bin_fac:
-            self.Y, self.X = zoom(np.random.random(raw_img_shape),
-                                  1. / bin_fac, order=1).shape
+            self.Y = int(round(raw_img_shape[0] / float(bin_fac)))
+            self.X = int(round(raw_img_shape[1] / float(bin_fac)))
         else:
             self.X = raw_img_shape[1]  # fast dimension
             self.Y = raw_img_shape[0]  # slow dimension
@@ -419,6 +762,12 @@ class InterpSimple:
         self.xring = self.Q * np.cos(self.PHI - np.pi) + self.x_center
         self.yring = self.Q * np.sin(self.PHI - np.pi) + self.y_center
 
+        if bin_fac:
+            self.xring = self._zoom_to_block_coordinates(
+                self.xring, self.X, raw_img_shape[1])
+            self.yring = self._zoom_to_block_coordinates(
+                self.yring, self.Y, raw_img_shape[0])
+
         self.xring_near = self.xring.astype(int) + \
             np.round(self.xring -
                      np.floor(self.xring)).astype(int)
@@ -428,11 +777,56 @@ class InterpSimple:
 #       'C' style ordering
         self.indices_1d = self.X * self.yring_near + self.xring_near
 
+        if bin_fac:
+            self._set_binning_operator()
+
+    def _zoom_to_block_coordinates(self, coords, num_binned, num_raw):
+        '''
+        ndimage.zoom put binned pixel j at raw pixel j * (num_raw - 1) /
+        (num_binned - 1), the block of binned pixel j is centered at raw
+        pixel j * bin_fac + (bin_fac - 1) / 2; returns the block
+        coordinates of the same raw positions
+        '''
+        raw = coords * (num_raw - 1) / float(max(num_binned - 1, 1))
+        return (raw - (self.bin_fac - 1) / 2.) / self.bin_fac
+
+    def _binned_pixel_edges(self, num_binned, num_raw):
+        edges = np.floor(np.arange(num_binned + 1) * float(self.bin_fac))
+        edges = np.minimum(edges.astype(int), num_raw)
+        starts = edges[:-1]
+        stops = np.maximum(edges[1:], np.minimum(starts + 1, num_raw))
+        return starts, stops
+
+    def _set_binning_operator(self):
+        '''
+        sparse matrix that averages, for each polar pixel, the raw
+        pixels that fall inside its binned pixel
+        '''
+        y_starts, y_stops = self._binned_pixel_edges(self.Y, self.raw_shape[0])
+        x_starts, x_stops = self._binned_pixel_edges(self.X, self.raw_shape[1])
+
+        yb, xb = np.divmod(self.indices_1d.ravel(), self.X)
+        y0, heights = y_starts[yb], (y_stops - y_starts)[yb]
+        x0, widths = x_starts[xb], (x_stops - x_starts)[xb]
+
+        dy = np.arange(heights.max())[None, :, None]
+        dx = np.arange(widths.max())[None, None, :]
+        inside = (dy < heights[:, None, None]) & (dx < widths[:, None, None])
+        raw_inds = self.raw_shape[1] * (y0[:, None, None] + dy) \
+            + (x0[:, None, None] + dx)
+        polar_inds = np.arange(yb.size)[:, None, None] * np.ones_like(inside)
+        weights = 1. / (heights * widths)[:, None, None] * np.ones_like(inside)
+
+        self._binning_op = sparse.csr_matrix(
+            (weights[inside], (polar_inds[inside], raw_inds[inside])),
+            shape=(yb.size, int(np.prod(self.raw_shape))))
+
     def nearest(self, data_img, dtype=np.float32):
         '''return a 2d np.array polar image'''
-        if self.y_centerin_fac:
-            data_img = zoom(data_img, 1. / self.y_centerin_fac, order=1)
         data = data_img.ravel()
+        if self.bin_fac:
+            polar_img = self._binning_op.dot(data)
+            return polar_img.reshape(self.indices_1d.shape)
         return data[self.indices_1d]
 
     def set_polar_tree( self, index_query_fname, weighted=True): 
@@ -442,17 +836,15 @@ class InterpSimple:
         #    for r in np.arange(self.qRmin, self.qRmax)]
         #self._dists, self._inds =  zip(*[ PT.tree.query(rps, k=4) for rps in ring_pts])
         
-        qf = h5py.File(index_query_fname, 'r')
-        if weighted:
-            grp = qf['nearest4']
-            self.weighted = True 
+        index_file = RingIndexFile(index_query_fname)
+        radii = np.arange(self.qRmin, self.qRmax)
+        self.weighted = weighted
+#       reads either layout, every radius must have the same number of
+#       phi points
+        if self.weighted:
+            self._dists, self._inds = index_file.rings('nearest4', radii)
         else:
-            self.weighted = False
-            grp = qf['nearest']
-        self._inds =  [ grp['inds'][r].value   
-            for r in list(map( str,np.arange(self.qRmin,self.qRmax)))]
-        self._dists =  [ grp['dists'][r].value   
-            for r in list(map( str,np.arange(self.qRmin,self.qRmax)))]
+            self._dists, self._inds = index_file.rings('nearest', radii)
 
     def nearest_query(self, data_img, dtype=np.float32, weighted=True):
         data = data_img.ravel()
@@ -464,6 +856,100 @@ class InterpSimple:
         return rings
 
 
+class RingIndexer:
+    def __init__(self, a, b, img_shape):
+        '''
+        Description
+        ===========
+        Maps out the detector pixels nearest to points on rings, computed
+        analytically from Cartesian coordinates (a vectorized replacement
+        for querying a PolarTree).
+
+        Parameters
+        ==========
+        `a`, `b` is the horizontal, vertical pixel coordinate where
+            forward beam intersects detector
+
+        `img_shape` is shape of two-dimensional diffraction image
+        '''
+        self.x_center = a
+        self.y_center = b
+        self.img_shape = img_shape
+
+    def ring_points(self, radii, nphi=None):
+        '''
+        Returns the per-radius offsets and the x,y coordinates of
+        the points on each ring; the points of radii[i] are
+        offsets[i]:offsets[i+1]
+
+        `nphi` is the number of points on each ring, defaults to
+            int(2*pi*radius), phi is linspaced between -pi and pi
+        '''
+        radii = np.asarray(radii)
+        if nphi is None:
+            nphis = (2 * np.pi * radii).astype(int)
+        else:
+            nphis = np.ones(len(radii), dtype=int) * nphi
+        offsets = np.concatenate(([0], np.cumsum(nphis)))
+
+        ring_ind = np.repeat(np.arange(len(radii)), nphis)
+        phi_ind = np.arange(offsets[-1]) - offsets[ring_ind]
+        phi_step = 2 * np.pi / np.maximum(nphis - 1, 1)
+        phis = -np.pi + phi_ind * phi_step[ring_ind]
+        R = radii[ring_ind]
+        x = self.x_center + R * np.cos(phis)
+        y = self.y_center + R * np.sin(phis)
+        return offsets, x, y
+
+    def query(self, radii, nphi=None, k=1):
+        '''
+        Find the k nearest pixels to the points on each ring
+
+        Returns
+        =======
+        A tuple of (`offsets`, `dists`, `inds`)
+
+        `offsets` where the points of each radius start and stop
+
+        `dists` Euclidean distances (pixel units) from each ring point to
+            its nearest pixels, in increasing order, shape (num_points,)
+            if k is 1 else (num_points x k)
+
+        `inds` the corresponding flattened pixel indices
+        '''
+        assert(1 <= k <= 4)
+        offsets, x, y = self.ring_points(radii, nphi)
+        ydim, xdim = self.img_shape
+
+        if k == 1:
+            xn = np.clip(np.round(x), 0, xdim - 1)
+            yn = np.clip(np.round(y), 0, ydim - 1)
+            dists = np.sqrt((xn - x)**2 + (yn - y)**2)
+            inds = yn.astype(int) * xdim + xn.astype(int)
+            return offsets, dists, inds
+
+#       the k<=4 nearest pixel centers are always inside the
+#       4x4 block of pixels surrounding the point
+        shifts = np.arange(-1, 3)
+        xc = np.floor(x)[:, None, None] + shifts[None, None, :]
+        yc = np.floor(y)[:, None, None] + shifts[None, :, None]
+        xc = np.clip(xc, 0, xdim - 1) * np.ones_like(yc)
+        yc = np.clip(yc, 0, ydim - 1) * np.ones_like(xc)
+        xc = xc.reshape((x.size, -1))
+        yc = yc.reshape((y.size, -1))
+
+        cand_dists = np.sqrt((xc - x[:, None])**2 + (yc - y[:, None])**2)
+        nearest_k = np.argpartition(cand_dists, k - 1, axis=1)[:, :k]
+        dists = np.take_along_axis(cand_dists, nearest_k, axis=1)
+        order = np.argsort(dists, axis=1)
+        nearest_k = np.take_along_axis(nearest_k, order, axis=1)
+        dists = np.take_along_axis(dists, order, axis=1)
+
+        inds = np.take_along_axis(yc, nearest_k, axis=1).astype(int) * xdim \
+            + np.take_along_axis(xc, nearest_k, axis=1).astype(int)
+        return offsets, dists, inds
+
+
 class PolarTree:
     def __init__(self, a, b, img_shape, offset_pix=False, nphi=None):
         self.img_shape = img_shape
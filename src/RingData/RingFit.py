@@ -14,6 +14,7 @@ class RingFit:
         self._set_circle_model()
         self._set_circle_model_fast()
         self._set_ellipse_model()
+        self._set_concentric_ellipse_model()
         
         self.img = np.copy(img)
         self._store_1D_image_index_arrays()
@@ -40,6 +41,16 @@ class RingFit:
                                   + (1/beta[3]/beta[3])*( x[1] -beta[1])**2-1
         self.ellipse_model = odr.Model( f_ellipse, implicit=True)
 
+    def _set_concentric_ellipse_model(self):
+#       Equation for concentric ellipses sharing a center (beta[0],beta[1]), 
+#       an ellipticity and a tilt (beta[2],beta[3]), with one scale per 
+#       ring (beta[4:]); x[2] is the ring each point belongs to
+        self.concentric_ellipse_model = odr.Model( 
+            self.concentric_ellipse_equation, 
+            implicit=True,
+            fjacd=self.concentric_ellipse_jacobian_data, 
+            fjacb=self.concentric_ellipse_jacobian_beta)
+
     def _store_1D_image_index_arrays(self):
 #       make 2d and 1d index arrays       
         self.y, self.x = np.indices( self.img.shape )
@@ -65,13 +76,7 @@ class RingFit:
         self.ring_width = ring_width
         self._prepare_fitting_framework( beta_i, num_high_pix, num_fitting_pts)
         self._fit_a_model_fast(self.circle_model_fast, param_guess=beta_i)
-    
-        x,y = self._get_xy()
-        a,b,r  = self.beta_fit
-        Ri = np.sqrt( (x-a)**2 + (y-b)**2)
-        self.residual = np.sum((Ri-r)**2)
-        mean_intens = self.img1D[ self.fit_indices].mean()
-        return self.beta_fit, self.residual, mean_intens
+        return self._circle_fit_result()
 
     def fit_circle( self, beta_i, num_fitting_pts=5000, 
                 ring_width=20 , num_high_pix=20, 
@@ -91,7 +96,37 @@ class RingFit:
         self.ring_width = ring_width
         self._prepare_fitting_framework( beta_i, num_high_pix, num_fitting_pts)
         self._fit_a_model(self.circle_model, param_guess=beta_i)
+        return self._circle_fit_result()
+
+    def fit_circles( self, betas_i, num_fitting_pts=5000, 
+                ring_width=20, num_high_pix=20, fast=False):
+        '''
+        Fit circles to several rings on the same image
+        ===============================================
+        betas_i         - sequence of float tuples, ( x_center, y_center,radius ),
+                            one guess per ring
+        fast            - bool, use the analytic jacobians of fit_circle_fast
+        
+        the other parameters are as in fit_circle; the fitting pixels of 
+        every ring are selected in one pass over the image
 
+        returns a list of ( beta_fit, residual, mean_intens ), one per ring
+        '''
+        self.ring_width = ring_width
+        all_fit_indices = self._prepare_fitting_frameworks( betas_i, 
+                                        num_high_pix, num_fitting_pts)
+        results = []
+        for beta_i, fit_indices in zip( betas_i, all_fit_indices):
+            self.fit_indices = fit_indices
+            if fast:
+                self._fit_a_model_fast(self.circle_model_fast, 
+                                        param_guess=beta_i)
+            else:
+                self._fit_a_model(self.circle_model, param_guess=beta_i)
+            results.append( self._circle_fit_result() )
+        return results
+
+    def _circle_fit_result(self):
         x,y = self._get_xy()
         a,b,r  = self.beta_fit
         Ri = np.sqrt( (x-a)**2 + (y-b)**2)
@@ -128,34 +163,182 @@ class RingFit:
         return self.beta_fit
 
 
+    def fit_concentric_ellipses(self, beta_i, num_fitting_pts=5000, 
+                        ring_width=20, num_high_pix=20):
+        '''
+        Fit one center, ellipticity and tilt to several rings at once
+        ==============================================================
+        beta_i          - float tuple, (x_center, y_center, radius_1, radius_2, ...)
+                            one guessed radius per ring
+
+        num_fitting_pts - int, number of pixels to include in fit, per ring
+
+        ring_width, num_high_pix are as in fit_circle
+
+        The rings are modeled as 
+            (1+p) dx**2 + 2 q dx dy + (1-p) dy**2 = r_k**2
+        with dx, dy the offsets from the shared center, so p = q = 0 is a 
+        set of concentric circles. The fit uses analytic jacobians.
+
+        returns beta_fit, (x_center, y_center, p, q, r_1, r_2, ...); the 
+        semi-axes of each ring are stored in self.ellipse_axes 
+        (num_rings x 2, major then minor), the angle of the major axis 
+        from the x axis (radians) in self.ellipse_tilt, and the summed 
+        squared distance of the fit pixels from the rings in self.residual
+        '''
+        self.ring_width = ring_width
+        x_center, y_center = beta_i[:2]
+        radii = beta_i[2:]
+        all_fit_indices = self._prepare_fitting_frameworks( 
+                                [ (x_center, y_center, r) for r in radii], 
+                                num_high_pix, num_fitting_pts)
+        self.fit_indices = np.concatenate( all_fit_indices)
+        ring_ids = np.repeat( np.arange( len(radii)), 
+                                [ len(inds) for inds in all_fit_indices] )
+        self.pts = np.vstack( [self.x1D[ self.fit_indices], 
+                                self.y1D[ self.fit_indices], ring_ids] )
+
+        beta0 = np.concatenate( ([x_center, y_center, 0, 0], radii) )
+        lsc_data = odr.Data( self.pts, y=1)
+#       the ring ids are exact, only the pixel coordinates are adjusted
+        lsc_odr = odr.ODR( lsc_data, self.concentric_ellipse_model, beta0, 
+                            ifixx=[1,1,0])
+        lsc_odr.set_job(deriv=3) 
+        lsc_out = lsc_odr.run()
+        self.beta_fit = lsc_out.beta
+        
+        f = self.concentric_ellipse_equation( self.beta_fit, self.pts)
+        df_dx = self.concentric_ellipse_jacobian_data( self.beta_fit, self.pts)
+        self.residual = np.sum( f**2 / ( df_dx[0]**2 + df_dx[1]**2 ) )
+
+        p, q = self.beta_fit[2:4]
+        m = np.sqrt( p**2 + q**2)
+        r = self.beta_fit[4:]
+        self.ellipse_axes = np.column_stack( [ r / np.sqrt(1-m), 
+                                                r / np.sqrt(1+m) ] )
+#       the major axis is along the eigenvector of the smaller eigenvalue
+        self.ellipse_tilt = 0.5 * np.arctan2( q, p) + np.pi / 2
+        return self.beta_fit
+
+    @staticmethod
+    def concentric_ellipse_equation( beta, x):
+        xc, yc, p, q = beta[:4]
+        r = beta[4:][ x[2].astype(int) ]
+        dx = x[0] - xc
+        dy = x[1] - yc
+        return (1+p)*dx**2 + 2*q*dx*dy + (1-p)*dy**2 - r**2
+
+    @staticmethod
+    def concentric_ellipse_jacobian_beta( beta, x):
+        xc, yc, p, q = beta[:4]
+        ring_ids = x[2].astype(int)
+        dx = x[0] - xc
+        dy = x[1] - yc
+        df_db    = np.zeros(( len(beta), x.shape[1]))
+        df_db[0] = -2*( (1+p)*dx + q*dy )         # d_f/dxc
+        df_db[1] = -2*( q*dx + (1-p)*dy )         # d_f/dyc
+        df_db[2] = dx**2 - dy**2                  # d_f/dp
+        df_db[3] = 2*dx*dy                        # d_f/dq
+        df_db[4 + ring_ids, np.arange(x.shape[1])] = \
+                            -2*beta[4:][ring_ids]  # d_f/dr_k
+        return df_db
+
+    @staticmethod
+    def concentric_ellipse_jacobian_data( beta, x):
+        xc, yc, p, q = beta[:4]
+        dx = x[0] - xc
+        dy = x[1] - yc
+        df_dx    = np.zeros_like( x, dtype=float)
+        df_dx[0] = 2*( (1+p)*dx + q*dy )          # d_f/dxi
+        df_dx[1] = 2*( q*dx + (1-p)*dy )          # d_f/dyi
+        return df_dx                              # d_f/d(ring id) = 0
+
     def _prepare_fitting_framework(self, ring_guess, num_high_pix, 
                                     num_fitting_pts):
-#       set the 1D image
-        self.img1D = np.copy(self.img.ravel())
-        self._mask_1D_image(ring_guess)
-        self._remove_highest(num_high_pix)
-        num_fitting_pts = self._check_num_fitting_points(num_fitting_pts)
-#       find indices of fit pixels in order of decreasing intensity 
-        self.fit_indices = np.argsort(self.img1D)[::-1][: num_fitting_pts]
-
-    def _mask_1D_image(self, beta_i):
-#       radius of each pixel 
-        radius_value = np.sqrt((self.x1D - beta_i[0])**2 + \
-                            (self.y1D - beta_i[1])**2 )
-        self.img1D[ radius_value > beta_i[2] + self.ring_width/2 ] = 0
-        self.img1D[ radius_value < beta_i[2] - self.ring_width/2 ] = 0
-        
+        self.fit_indices = self._prepare_fitting_frameworks( [ring_guess], 
+                                    num_high_pix, num_fitting_pts)[0]
 
-    def _remove_highest( self, num_high_pix):
+    def _prepare_fitting_frameworks(self, ring_guesses, num_high_pix, 
+                                    num_fitting_pts):
+#       the 1D image, only pixels inside the ring annuli are ever read
+        self.img1D = self.img.ravel()
+        all_fit_indices = []
+        for annulus in self._annulus_indices( ring_guesses):
+            ring_vals = self.img1D[ annulus]
+            ring_vals = self._remove_highest( ring_vals, num_high_pix)
+            num_pts = self._check_num_fitting_points( ring_vals, 
+                                                    num_fitting_pts)
+#           find indices of fit pixels in order of decreasing intensity 
+            top = np.arange( len(ring_vals))
+            if num_pts < len(ring_vals):
+                top = np.argpartition( ring_vals, len(ring_vals) - num_pts)
+                top = top[ len(ring_vals) - num_pts:]
+            top = top[ np.argsort( ring_vals[top])[::-1] ]
+            all_fit_indices.append( annulus[top])
+        return all_fit_indices
+
+    def _annulus_indices(self, ring_guesses):
+#       flat indices of the pixels within ring_width/2 of each guessed 
+#       circle (beta[2] is the radius, or the x radius of an ellipse). 
+#       On each row, the pixels of an annulus form at most two runs of 
+#       columns, one on either side of the center, so only those runs 
+#       (widened by a pixel, then trimmed by the exact radius test) are 
+#       visited, and all rings are located in one pass over the rows 
+        guesses = np.array( [ beta[:3] for beta in ring_guesses], dtype=float)
+        Ydim, Xdim = self.img.shape
+        a = guesses[:,0][:,None]
+        b = guesses[:,1][:,None]
+        r_in = guesses[:,2][:,None] - self.ring_width/2
+        r_out = guesses[:,2][:,None] + self.ring_width/2
+        
+        rows = np.arange( Ydim)[None,:]
+        dy2 = (rows - b)**2
+        half_out = np.sqrt( np.maximum( r_out**2 - dy2, 0) )
+        half_in = np.sqrt( np.maximum( np.maximum(r_in, 0)**2 - dy2, 0) )
+        split = np.clip( np.ceil(a), 0, Xdim)
+        
+        left_start = np.ceil( a - half_out) - 1
+        left_stop = np.minimum( np.floor( a - half_in) + 2, split)
+        right_start = np.maximum( np.ceil( a + half_in) - 1, split)
+        right_stop = np.floor( a + half_out) + 2
+        starts = np.clip( np.stack( [left_start, right_start], -1), 0, Xdim)
+        stops = np.clip( np.stack( [left_stop, right_stop], -1), 0, Xdim)
+        lengths = np.maximum( stops - starts, 0)
+        lengths[ dy2 > r_out**2 ] = 0
+        starts = starts.astype(int)
+        lengths = lengths.astype(int)
+
+        annuli = []
+        run_rows = np.repeat( rows[0], 2)
+        for i_ring in range( len(guesses)):
+            run_lengths = lengths[i_ring].ravel()
+            run_starts = starts[i_ring].ravel()
+            run_offsets = np.cumsum( run_lengths) - run_lengths
+            x = np.arange( run_lengths.sum()) - \
+                    np.repeat( run_offsets - run_starts, run_lengths)
+            y = np.repeat( run_rows, run_lengths)
+            radius_value = np.sqrt((x - a[i_ring,0])**2 + \
+                                (y - b[i_ring,0])**2 )
+            in_ring = (radius_value <= r_out[i_ring,0]) & \
+                        (radius_value >= r_in[i_ring,0])
+            annuli.append( y[in_ring]*Xdim + x[in_ring] )
+        return annuli
+
+    def _remove_highest( self, ring_vals, num_high_pix):
 #       removes the highest pixels so they don't corrupt the fit 
 #           (e.g. bad pixels)
-        high_inds = np.argsort( self.img1D )[:num_high_pix]
-        self.img1D[ high_inds ] = 0
-
-    def _check_num_fitting_points(self, num_fitting_pts):
-        num_pts = np.where( self.img1D > 0 )[0].shape[0]
+        num_high_pix = min( num_high_pix, len(ring_vals))
+        ring_vals = np.copy( ring_vals)
+        if num_high_pix > 0:
+            high_inds = np.argpartition( ring_vals, 
+                                    len(ring_vals) - num_high_pix)
+            ring_vals[ high_inds[ len(ring_vals) - num_high_pix:] ] = 0
+        return ring_vals
+
+    def _check_num_fitting_points(self, ring_vals, num_fitting_pts):
+        num_pts = np.count_nonzero( ring_vals > 0 )
         if num_fitting_pts >= num_pts :
-            num_fitting_pts = num_pts / 2
+            num_fitting_pts = num_pts // 2
         return num_fitting_pts
 
        
@@ -208,7 +391,7 @@ class RingFit:
 
 
     def fit_circle_slow(self, beta_i, ring_scan_width, center_scan_width, 
-                            resolution=1 ):
+                            resolution=1, search='grid' ):
         """
         Description
         ===========
@@ -230,6 +413,13 @@ class RingFit:
         `ring_scan_width`   how many pixels to scan for ring maxima
         `center_scan_width`  how many pixels to scan in horizontal and vertical 
                             diredtions for ring maxima
+        `resolution`    spacing of the candidate centers, in pixels
+        `search`    'grid' evaluates every candidate center on a grid with 
+                    spacing of about `resolution`. 'coarse_to_fine' starts
+                    from a 3x3 grid spanning `center_scan_width`, and keeps
+                    halving its spacing around the best center until the 
+                    spacing is below `resolution`; this takes tens of radial 
+                    profiles instead of (center_scan_width/resolution)**2
         
         Returns
         =======
@@ -245,14 +435,18 @@ class RingFit:
         self.RadPro = RadialProfile( center=(self.center_x_guess, \
                                         self.center_y_guess), 
                                 img_shape=self.img.shape, mask=None, 
-                                minlength=self.img.shape[0] )
+                                minlength=self.img.shape[0], compact=True )
 
         self._set_radial_scan_range(ring_scan_width)
-        self._define_possible_center_coordinates(center_scan_width)
-        self._store_profiles_for_each_center()
-        self._store_maxima_of_each_profile()
-        self._find_center_with_maximum_ring_profile()
-        self._set_max_ring_profile()
+        if search == 'coarse_to_fine':
+            self._refine_center_coarse_to_fine(center_scan_width)
+        else:
+            assert( search == 'grid')
+            self._define_possible_center_coordinates(center_scan_width)
+            self._store_profiles_for_each_center()
+            self._store_maxima_of_each_profile()
+            self._find_center_with_maximum_ring_profile()
+            self._set_max_ring_profile()
        
         return self._get_fit_parameters()
         
@@ -279,14 +473,35 @@ class RingFit:
                             for y in scan_range_y]
 
     def _store_profiles_for_each_center(self):
-        self.possible_ring_profiles = []
-        for center in self.possible_centers:
-            self.RadPro.update_center( center)
-            radial_profile = self.RadPro.calculate(self.img) 
-            ring_profile = radial_profile[ int(self.ring_scan_start):\
-                                            int(self.ring_scan_stop)]
-            self.possible_ring_profiles.append( ring_profile)
+        self.possible_ring_profiles = list( self.RadPro.calculate_windowed( 
+                                        self.img, self.possible_centers, 
+                                        int(self.ring_scan_start), 
+                                        int(self.ring_scan_stop)) )
     
+    def _refine_center_coarse_to_fine(self, center_scan_width):
+#       the ring peak height falls off with the distance from the true
+#       center, so the best center always lies within one grid spacing of
+#       the best point of the current 3x3 grid
+        grid_offsets = np.array( [ (dx,dy) for dx in (-1,0,1) 
+                                    for dy in (-1,0,1) ] )
+        center = np.array( [self.center_x_guess, self.center_y_guess], 
+                            dtype=float)
+        spacing = center_scan_width / 2.
+        self.num_profile_evaluations = 0
+        while True:
+            centers = center + spacing * grid_offsets
+            ring_profiles = self.RadPro.calculate_windowed( self.img, centers, 
+                                            int(self.ring_scan_start), 
+                                            int(self.ring_scan_stop))
+            self.num_profile_evaluations += len(centers)
+            i_best = np.argmax( ring_profiles.max(1) )
+            center = centers[i_best]
+            self.max_profile = ring_profiles[i_best]
+            if spacing <= self.resolution:
+                break
+            spacing /= 2.
+        self.fit_center = tuple( center)
+
     def _store_maxima_of_each_profile(self):
         self.ring_profile_maxima = [ max( ring_profile) 
                         for ring_profile in self.possible_ring_profiles ]
@@ -0,0 +1,176 @@
+import h5py
+import numpy as np
+
+PACKED_LAYOUT = 'packed_csr'
+INDEX_KINDS = ('nearest', 'nearest4')
+
+
+class RingIndexFile:
+    def __init__(self, fname):
+        '''
+        Description
+        ===========
+        Reads a ring index file made by loki.queryRingIndices, in either
+        layout:
+
+        legacy  one dataset per radius per kind, e.g. nearest/inds/123,
+                nearest4/dists/123
+
+        packed  one CSR-style group per kind holding `offsets`, `inds`
+                and `dists`, plus a top-level `radii` array; the points
+                of radii[i] are rows offsets[i]:offsets[i+1] of `inds`
+                and `dists`. Uncompressed packed datasets are
+                memory-mapped instead of read.
+
+        Parameters
+        ==========
+        `fname` is the name of the index file
+        '''
+        self.fname = fname
+        with h5py.File(fname, 'r') as index_file:
+            self.packed = index_file.attrs.get('layout') in \
+                [PACKED_LAYOUT, PACKED_LAYOUT.encode()]
+            if self.packed:
+                self.radii = index_file['radii'][()]
+            else:
+                self.radii = np.array(sorted(
+                    map(int, index_file['nearest/inds'].keys())))
+
+    def load(self, kind):
+        '''
+        Returns a tuple of (`offsets`, `dists`, `inds`) for every radius
+        in the file, `kind` is 'nearest' or 'nearest4'
+        '''
+        assert(kind in INDEX_KINDS)
+        if self.packed:
+            return self._load_packed(kind)
+        return self._load_legacy(kind)
+
+    def _load_packed(self, kind):
+        with h5py.File(self.fname, 'r') as index_file:
+            grp = index_file[kind]
+            offsets = grp['offsets'][()]
+            dists = self._map_dataset(grp['dists'])
+            inds = self._map_dataset(grp['inds'])
+        return offsets, dists, inds
+
+    def _map_dataset(self, dset):
+        offset = dset.id.get_offset()
+        if dset.chunks is not None or offset is None:
+            return dset[()]
+        return np.memmap(self.fname, mode='r', dtype=dset.dtype,
+                         shape=dset.shape, offset=offset)
+
+    def _load_legacy(self, kind):
+        with h5py.File(self.fname, 'r') as index_file:
+            grp = index_file[kind]
+            dists = [grp["dists/%d" % r][()] for r in self.radii]
+            inds = [grp["inds/%d" % r][()] for r in self.radii]
+        offsets = np.concatenate(([0], np.cumsum([len(i) for i in inds])))
+        return offsets, np.concatenate(dists), np.concatenate(inds)
+
+    def rings(self, kind, radii):
+        '''
+        Returns the (`dists`, `inds`) of the given consecutive `radii`,
+        stacked into arrays of shape (num_radii x num_phi [x 4]); every
+        radius must have the same number of points
+        '''
+        radii = np.asarray(radii)
+        offsets, dists, inds = self.load(kind)
+        i_rad = np.searchsorted(self.radii, radii)
+        assert(np.all(self.radii[i_rad] == radii))
+        assert(np.all(np.diff(i_rad) == 1))
+        nphis = offsets[i_rad + 1] - offsets[i_rad]
+        assert(np.all(nphis == nphis[0]))
+        start, stop = offsets[i_rad[0]], offsets[i_rad[-1] + 1]
+        shape = (len(radii), nphis[0]) + dists.shape[1:]
+        return (np.asarray(dists[start:stop]).reshape(shape),
+                np.asarray(inds[start:stop]).reshape(shape))
+
+
+class RingIndexWriter:
+    def __init__(self, fname, radii, nphis, compression=None,
+                 chunk_size=2**16):
+        '''
+        Description
+        ===========
+        Writes a packed ring index file (see RingIndexFile). The datasets
+        are allocated up front, and ring data is written one block of
+        consecutive radii at a time, in order.
+
+        Parameters
+        ==========
+        `fname` is the name of the output file
+
+        `radii` are the ring radii, in the order they will be written
+
+        `nphis` are the number of points on each ring
+
+        `compression` e.g. 'gzip' or 'lzf'; compressed datasets are
+            chunked (`chunk_size` points per chunk) and cannot be
+            memory-mapped by the reader, uncompressed ones are stored
+            contiguously
+        '''
+        self.radii = np.asarray(radii)
+        self.offsets = np.concatenate(([0], np.cumsum(nphis)))
+        self._next_radius = 0
+
+        self.index_file = h5py.File(fname, 'w')
+        self.index_file.attrs['layout'] = PACKED_LAYOUT
+        self.index_file.create_dataset('radii', data=self.radii)
+        num_points = int(self.offsets[-1])
+        for kind in INDEX_KINDS:
+            grp = self.index_file.create_group(kind)
+            grp.create_dataset('offsets', data=self.offsets)
+            shape = (num_points,)
+            if kind == 'nearest4':
+                shape = (num_points, 4)
+            kwargs = {}
+            if compression is not None:
+                chunks = (min(chunk_size, max(num_points, 1)),) + shape[1:]
+                kwargs = {'chunks': chunks, 'compression': compression}
+            grp.create_dataset('dists', shape=shape, dtype=np.float64,
+                               **kwargs)
+            grp.create_dataset('inds', shape=shape, dtype=np.int64,
+                               **kwargs)
+
+    def write(self, num_radii, rings):
+        '''
+        Write the next `num_radii` radii
+
+        `rings` is a dictionary mapping 'nearest' and 'nearest4' to a tuple
+            of (`dists`, `inds`) for the points on those radii, e.g. as
+            returned by RingIndexer.query
+        '''
+        i_start = self._next_radius
+        i_stop = i_start + num_radii
+        start, stop = self.offsets[i_start], self.offsets[i_stop]
+        for kind in INDEX_KINDS:
+            dists, inds = rings[kind]
+            assert(len(dists) == stop - start)
+            self.index_file[kind]['dists'][start:stop] = dists
+            self.index_file[kind]['inds'][start:stop] = inds
+        self._next_radius = i_stop
+
+    def close(self):
+        assert(self._next_radius == len(self.radii))
+        self.index_file.close()
+
+
+def convert_ring_index_file(legacy_fname, packed_fname, compression=None):
+    '''
+    Converts a legacy (one dataset per radius) ring index file into the
+    packed layout
+    '''
+    legacy = RingIndexFile(legacy_fname)
+    assert(not legacy.packed)
+    offsets, dists, inds = legacy.load('nearest')
+    offsets4, dists4, inds4 = legacy.load('nearest4')
+    assert(np.all(offsets == offsets4))
+
+    writer = RingIndexWriter(packed_fname, legacy.radii, np.diff(offsets),
+                             compression=compression)
+    writer.write(len(legacy.radii), {'nearest': (dists, inds),
+                                     'nearest4': (dists4, inds4)})
+    writer.close()
+    return packed_fname
@@ -3,8 +3,11 @@
 from .RingFetch import RingFetch
 from .InterpSimple import InterpSimple
 from .RingFetch import PolarTree
+from .RingFetch import RingIndexer
 from .RadialProfile import RadialProfile
 from .DiffCorr import DiffCorr
 from .RingFit import RingFit
 from .InterpCorr import InterpCorr
 from .WeighAverage import WeighAverage
+from .GeometryCache import GeometryCache
+from .RingIndexFile import RingIndexFile, RingIndexWriter, convert_ring_index_file
@@ -1,8 +1,11 @@
+from multiprocessing import Pool
+from numbers import Number
+
 import numpy as np
 import h5py
 
 
-from loki.RingData import InterpSimple, RingFetch, RadialProfile
+from loki.RingData import InterpSimple, RingFetch, RadialProfile, RingFit
 from loki.utils.postproc_helper import smooth
 
 #####################################################
@@ -143,7 +146,7 @@ def selectImages(runfile, probe=True, pump=False, beam=True):
 
 
 def aveImages(imggen, num_img):
-    im = imggen.next()
+    im = next(imggen)
     for im_next in imggen:
         im += im_next
     im /= num_img
@@ -157,6 +160,10 @@ def normalize_polar_images(imgs, mask_val=-1):
     return imgs
 
 
+# most interpolation geometries interpolate_run keeps in memory at once
+MAX_CACHED_CENTERS = 32
+
+
 def interpolate_run(
         img_gen,
         tags,
@@ -179,7 +186,9 @@ def interpolate_run(
         qmin_pix=None,
         qmax_pix=None,
         detector_gain=None,
-        index_query_fname=None):
+        index_query_fname=None,
+        cache_dir=None,
+        center_resolution=None):
     """
     Description
     ===========
@@ -204,11 +213,12 @@ def interpolate_run(
 
     x_center,    float, pixel unit where beam hits detector,
                 x dimension( fast dimension), measured from
-                 0,0 pixel corner
+                 0,0 pixel corner, or a list with one value per image
+                 (e.g. from load_geometry_table)
 
     y_center,    float,  pixel unit where beam hits detector,
                  y dimension( slow dimension), measured from
-                  0,0 pixel corner
+                  0,0 pixel corner, or a list with one value per image
 
     detdist,     float, sample to detector distance in meter
 
@@ -258,6 +268,18 @@ def interpolate_run(
 
     detector_gain,    float, absolute gain of detector
 
+    cache_dir,        str, directory where precomputed interpolation
+                        geometry is stored and re-used across runs
+                        that share the same geometry (only the geometry
+                        of the first shot's center is stored)
+
+    center_resolution, float, per-shot centers are rounded to multiples
+                        of this many pixels, so the interpolation geometry
+                        is built once per distinct rounded center rather
+                        than once per shot (None keeps the exact centers).
+                        Only 'fetch' with interp_method 'floor' or 'count',
+                        and 'polar', can follow per-shot centers
+
 
     Returns
     =======
@@ -272,9 +294,7 @@ def interpolate_run(
 
     num_imgs = len(tags)
 
-    if isinstance(
-            wavelen, (int, float, long, complex)) and isinstance(
-            detdist, (int, float, long, complex)):
+    if isinstance(wavelen, Number) and isinstance(detdist, Number):
 
         wavelen, detdist = [wavelen] * num_imgs, [detdist] * num_imgs
 
@@ -284,6 +304,22 @@ def interpolate_run(
         assert(isinstance(detdist, (list, np.ndarray)))
         assert(len(wavelen) == len(detdist) == num_imgs)
 
+    if np.ndim(x_center) == 0 and np.ndim(y_center) == 0:
+
+        x_center, y_center = [x_center] * num_imgs, [y_center] * num_imgs
+
+    else:
+
+        assert(len(x_center) == len(y_center) == num_imgs)
+
+        if center_resolution is not None:
+            x_center, y_center = [
+                list(np.round(np.asarray(center, dtype=float) /
+                              center_resolution) * center_resolution)
+                for center in (x_center, y_center)]
+
+    constant_center = len(set(zip(x_center, y_center))) == 1
+
     if detector_gain is None:
 
         detector_gain, photon_conversion_factor = -1, [1] * num_imgs
@@ -303,6 +339,12 @@ def interpolate_run(
             
             assert( nphi is not None)
 
+#           the index file of 'polar_n' was computed for one center
+            assert(how == 'polar' or constant_center)
+
+#           one interpolater and polar mask per distinct center
+            interpolaters = {}
+
             for i_tag, tag in enumerate(tags):
 
                 pix2invang = lambda qpix: np.sin(np.arctan(
@@ -321,21 +363,34 @@ def interpolate_run(
 
                     qmax_pix = invang2pix(qmax)
 
-#           Initialize the interpolater
-                interpolater  = InterpSimple( x_center, y_center, qmax_pix, qmin_pix, nphi, 
-                                                raw_img_shape=mask.shape )
-
-                if how == 'polar_n':
-                    interpolater.set_polar_tree(index_query_fname, weighted=False)
-                    pmeth = interpolater.nearest_query
-                else:
-                    pmeth = interpolater.nearest
+                center = (x_center[i_tag], y_center[i_tag])
+                if center not in interpolaters:
+                    if len(interpolaters) >= MAX_CACHED_CENTERS:
+                        interpolaters.clear()
+#           Initialize the interpolater, per-shot centers are not cached
+                    if center == (x_center[0], y_center[0]):
+                        center_cache_dir = cache_dir
+                    else:
+                        center_cache_dir = None
+                    interpolater  = InterpSimple( center[0], center[1], 
+                                                qmax_pix, qmin_pix, nphi, 
+                                                raw_img_shape=mask.shape, 
+                                                cache_dir=center_cache_dir )
+
+                    if how == 'polar_n':
+                        interpolater.set_polar_tree(index_query_fname, weighted=False)
+                        pmeth = interpolater.nearest_query
+                    else:
+                        pmeth = interpolater.nearest
 #           make a polar image mask
-                pmask   = pmeth( mask.astype(float) )  #.round()
-                pmask = pmask.astype(int).astype(bool)
+                    pmask   = pmeth( mask.astype(float) )  #.round()
+                    pmask = pmask.astype(int).astype(bool)
+                    interpolaters[center] = (pmeth, pmask)
+
+                pmeth, pmask = interpolaters[center]
 
 #           Make the polar images
-                polar_img = pmask * pmeth( img_gen.next()) \
+                polar_img = pmask * pmeth( next(img_gen)) \
                                 * photon_conversion_factor[i_tag]
 
                 output_hdf.create_dataset('ring_intensities/%s'%tag, data=polar_img, dtype=np.float32)
@@ -362,52 +417,46 @@ def interpolate_run(
             assert(ring_locations is not None)
 
             fetcher = RingFetch(
-                a=x_center,
-                b=y_center,
+                a=x_center[0],
+                b=y_center[0],
                 img_shape=mask.shape,
                 mask=mask,
                 q_resolution=q_resolution,
                 phi_resolution=phi_resolution,
                 pixsize=pixsize,
                 interp_method=interp_method,
-                index_query_fname=index_query_fname)
+                index_query_fname=index_query_fname,
+                cache_dir=cache_dir)
 
             ring_radii = np.zeros((num_imgs, len(ring_locations)))
             ring_mag = np.zeros_like(ring_radii)
 
             for i_tag, tag in enumerate(tags):
 
+                fetcher.set_center(x_center[i_tag], y_center[i_tag])
+
                 fetcher.set_params(wavelen[i_tag], detdist[i_tag])
 
                 fetcher.set_photon_factor(photon_conversion_factor[i_tag])
 
-                fetcher.set_working_image(img_gen.next())
-
-                intensities = np.zeros(
-                    (len(ring_locations), fetcher.num_phi_nodes))
+                fetcher.set_working_image(next(img_gen))
 
                 if radius_unit == 'inv_ang':
 
-                    for ring_index, ring_q in enumerate(ring_locations):
-
-                        intensities[ring_index] = \
-                            fetcher.fetch_a_ring(q=ring_q)
+                    intensities = fetcher.fetch_rings(qs=ring_locations)
 
-                        ring_radii[i_tag, ring_index] = int(
-                            round(fetcher.q2r(ring_q)))
+                    ring_radii[i_tag] = np.round(
+                        fetcher.q2r(np.asarray(ring_locations))).astype(int)
 
-                        ring_mag[i_tag, ring_index] = ring_q
+                    ring_mag[i_tag] = ring_locations
 
                 else:
 
-                    for ring_index, ring_radius in enumerate(ring_locations):
+                    intensities = fetcher.fetch_rings(radii=ring_locations)
 
-                        intensities[ring_index] = \
-                            fetcher.fetch_a_ring(radius=ring_radius)
+                    ring_radii[i_tag] = ring_locations
 
-                        ring_radii[i_tag, ring_index] = ring_radius
-
-                        ring_mag[i_tag, ring_index] = fetcher.r2q(ring_radius)
+                    ring_mag[i_tag] = fetcher.r2q(np.asarray(ring_locations))
 
                 output_hdf.create_dataset('ring_intensities/%s' % tag,
                                           data=intensities, dtype=np.float32)
@@ -437,6 +486,8 @@ def interpolate_run(
         output_hdf.create_dataset('how', data=how)
         output_hdf.create_dataset('interp_method', data=interp_method)
 
+        if constant_center:
+            x_center, y_center = x_center[0], y_center[0]
         output_hdf.create_dataset('x_center', data=x_center, dtype=np.float32)
         output_hdf.create_dataset('y_center', data=y_center, dtype=np.float32)
         output_hdf.create_dataset('wavelen', data=wavelen, dtype=np.float32)
@@ -566,7 +617,13 @@ def calibrate(img_gen, center, wavescan, detscan, q1_sim=2.48, q2_sim=2.99,
               mask=None, index_query_fname=None, scan_width=50,
               beta=20, window_size=40, factor=0.007, pixsize=0.00005):
     """Use this function to calibrate the detector distance and the wavelength
-    for a particular group of images (e.g. from a run)"""
+    for a particular group of images (e.g. from a run)
+
+    `speed`     'slow' finds the rings in solid angle corrected, split-pixel
+                radial profiles (RadialProfile.integrate), 'fetch' does the
+                same with RingFetch (using `index_query_fname`, if given),
+                anything else uses the uncorrected RadialProfile.calculate
+    """
 
     rad1_guess = int(
         round(
@@ -600,11 +657,22 @@ def calibrate(img_gen, center, wavescan, detscan, q1_sim=2.48, q2_sim=2.99,
         pixsize=pixsize,
         factor=factor)
 
+    if speed == 'slow':
+        # one bin centered on each integer radius of both scans
+        rad_scan_start = min(rad1_scan[0], rad2_scan[0])
+        rad_scan_stop = max(rad1_scan[-1], rad2_scan[-1]) + 1
+        radpro.set_integrator(
+            np.arange(rad_scan_start, rad_scan_stop + 1) - 0.5)
+
     detdists, wavelens, scores = [], [], []
 
     for img in img_gen:
         print ("\nCalibrating a new image...")
         if speed == 'slow':
+            rp = radpro.integrate(img)
+            rp1 = rp[rad1_scan - rad_scan_start]
+            rp2 = rp[rad2_scan - rad_scan_start]
+        elif speed == 'fetch':
             rp1 = radpro.calculate_using_fetch(
                 img, rad1_scan, index_query_fname=index_query_fname)
             rp2 = radpro.calculate_using_fetch(
@@ -666,3 +734,143 @@ def calibrate(img_gen, center, wavescan, detscan, q1_sim=2.48, q2_sim=2.99,
         scores.append(score)
 
     return detdists, wavelens, scores
+
+
+GEOMETRY_COLUMNS = ('x_center', 'y_center', 'radius', 'residual')
+
+
+def _fit_shot_geometry(fit_args):
+    """fits one (averaged) image, runs in the worker processes of
+    refine_run_geometry"""
+    img, beta_i, fit, num_fitting_pts, ring_width, num_high_pix = fit_args
+    ring_fit = RingFit(img)
+    if fit == 'ellipse':
+        a, b, x_radius, y_radius = ring_fit.fit_ellipse(
+            beta_i, num_fitting_pts=num_fitting_pts,
+            ring_width=ring_width, num_high_pix=num_high_pix)
+#       radial distances of the fit pixels from the ellipse, in pixels
+        x, y = ring_fit._get_xy()
+        radius = (x_radius + y_radius) / 2.
+        rho = np.sqrt(((x - a) / x_radius)**2 + ((y - b) / y_radius)**2)
+        residual = np.sum(((rho - 1) * radius)**2)
+        return a, b, radius, residual
+
+    beta_fit, residual, _ = ring_fit.fit_circle(
+        beta_i, num_fitting_pts=num_fitting_pts,
+        ring_width=ring_width, num_high_pix=num_high_pix)
+    return beta_fit[0], beta_fit[1], beta_fit[2], residual
+
+
+def refine_run_geometry(img_gen, beta_i, fit='circle', shots_per_fit=1,
+                        workers=1, num_fitting_pts=5000, ring_width=20,
+                        num_high_pix=20):
+    """
+    Description
+    ===========
+
+    Fits the forward beam position and a ring radius to every shot of a
+    run (or to every average of `shots_per_fit` consecutive shots), so the
+    shot to shot jitter of the center can be corrected in interpolate_run.
+
+    Parameters
+    ==========
+
+    img_gen,        generator of 2d np.array float images of a run
+
+    beta_i,         tuple, initial guess (x_center, y_center, radius) for
+                    a circle fit, (x_center, y_center, x_radius, y_radius)
+                    for an ellipse fit, in pixel units
+
+    fit,            str, 'circle' or 'ellipse' (see RingFit)
+
+    shots_per_fit,  int, number of consecutive shots averaged per fit
+
+    workers,        int, number of processes fitting the shots in parallel
+
+    num_fitting_pts, ring_width, num_high_pix are as in RingFit.fit_circle
+
+    Returns
+    =======
+
+    a 2d np.array geometry table, one row per fit, with the columns in
+    GEOMETRY_COLUMNS: x_center, y_center, radius (the mean of the x and y
+    radii for an ellipse) and residual (summed squared radial distance
+    of the fit pixels from the fitted shape)
+    """
+
+    assert(fit in ['circle', 'ellipse'])
+
+    def fit_args():
+        imgs = []
+        for img in img_gen:
+            imgs.append(img)
+            if len(imgs) == shots_per_fit:
+                yield (np.mean(imgs, axis=0), beta_i, fit, num_fitting_pts,
+                       ring_width, num_high_pix)
+                imgs = []
+        if imgs:
+            yield (np.mean(imgs, axis=0), beta_i, fit, num_fitting_pts,
+                   ring_width, num_high_pix)
+
+    if workers > 1:
+        #   imap returns the fits in shot order
+        pool = Pool(workers)
+        table = list(pool.imap(_fit_shot_geometry, fit_args()))
+        pool.close()
+        pool.join()
+    else:
+        table = [_fit_shot_geometry(args) for args in fit_args()]
+
+    return np.array(table, dtype=float).reshape((-1, len(GEOMETRY_COLUMNS)))
+
+
+def save_geometry_table(fname, table, shots_per_fit=1, tags=None,
+                        num_shots=None):
+    """
+    Saves a geometry table made by refine_run_geometry to an hdf5 file,
+    one dataset per column, along with `shots_per_fit`, the shot `tags`
+    and `num_shots`, the number of shots in the run (taken from `tags` if
+    not given; needed when the last fit averaged fewer than
+    `shots_per_fit` shots)
+    """
+    if num_shots is None:
+        if tags is not None:
+            num_shots = len(tags)
+        else:
+            assert(shots_per_fit == 1)
+            num_shots = len(table)
+    assert(len(table) == -(-num_shots // shots_per_fit))
+    with h5py.File(fname, 'w') as geom_hdf:
+        for i_col, column in enumerate(GEOMETRY_COLUMNS):
+            geom_hdf.create_dataset(column, data=table[:, i_col])
+        geom_hdf.create_dataset('shots_per_fit', data=shots_per_fit)
+        geom_hdf.create_dataset('num_shots', data=num_shots)
+        if tags is not None:
+            geom_hdf.create_dataset('tags', data=np.array(tags, dtype='S'))
+
+
+def load_geometry_table(fname):
+    """
+    Loads a geometry table saved by save_geometry_table
+
+    Returns
+    =======
+
+    a dictionary mapping each of GEOMETRY_COLUMNS to an array with one
+    value per shot (rows fit to several shots are repeated), so that
+    table['x_center'] and table['y_center'] can be passed as the
+    x_center and y_center of interpolate_run
+    """
+    with h5py.File(fname, 'r') as geom_hdf:
+        shots_per_fit = int(geom_hdf['shots_per_fit'][()])
+        table = dict((column, np.repeat(geom_hdf[column][()], shots_per_fit))
+                     for column in GEOMETRY_COLUMNS)
+        if 'num_shots' in geom_hdf:
+            num_shots = int(geom_hdf['num_shots'][()])
+        elif 'tags' in geom_hdf:
+            num_shots = len(geom_hdf['tags'])
+        else:
+            num_shots = len(table[GEOMETRY_COLUMNS[0]])
+        table = dict((column, values[:num_shots])
+                     for column, values in table.items())
+    return table